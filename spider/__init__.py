@@ -49,6 +49,7 @@ class Plugin(pwem.Plugin):
         cls._defineEmVar(SPIDER_HOME, 'spider-26.06')
         cls._defineVar(SPIDER, 'spider_linux_mp_intel64')
         cls._defineVar(SPIDER_MPI, 'spider_linux_mpi_opt64')
+        cls._defineVar(SPIDER_CACHE_SIZE, '0')
 
     @classmethod
     def getEnviron(cls):
@@ -71,6 +72,9 @@ class Plugin(pwem.Plugin):
                 logger.error("ERRORS: {errors}")
 
         env.set('PATH', env[SPBIN_DIR], env.END)
+        # The scripts print the time with 'date', parsed by
+        # SpiderProgressMonitor in the default (C locale) format
+        env.update({'LC_ALL': 'C'})
         return env
 
     @classmethod
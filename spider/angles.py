@@ -0,0 +1,115 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy
+from scipy.spatial import cKDTree
+
+from .utils import SpiderDocFile
+
+
+def getEvenAngles(angStep, thetaRange=(0, 90), phiRange=(0, 359.9)):
+    """ Return the (psi, theta, phi) angles of projection directions
+    evenly distributed on the sphere, following the scheme of SPIDER
+    VO EA: rings of constant theta every angStep degrees, each ring
+    with a phi step of about angStep / sin(theta).
+    """
+    theta1, theta2 = thetaRange
+    phi1, phi2 = phiRange
+    angles = []
+
+    numberOfRings = int((theta2 - theta1) / angStep + 0.5) + 1
+    for i in range(numberOfRings):
+        theta = min(theta1 + i * angStep, theta2)
+        if theta in (0, 180):
+            phiStep, n = 360., 1
+        else:
+            phiStep = angStep / numpy.sin(numpy.radians(theta))
+            n = max(int((phi2 - phi1) / phiStep) - 1, 1)
+            phiStep = (phi2 - phi1) / n
+        for j in range(n):
+            angles.append((0, theta, phi1 + j * phiStep))
+
+    return numpy.array(angles, dtype=float)
+
+
+def anglesToVectors(theta, phi):
+    """ Unit vectors of the projection directions (in degrees). """
+    theta = numpy.radians(theta)
+    phi = numpy.radians(phi)
+    sinTheta = numpy.sin(theta)
+    return numpy.column_stack([sinTheta * numpy.cos(phi),
+                               sinTheta * numpy.sin(phi),
+                               numpy.cos(theta)])
+
+
+class AngularIndex(object):
+    """ KD-tree on the unit vectors of the reference directions, to
+    find the references within an angular distance of the particles.
+    """
+    def __init__(self, angles):
+        """ angles: array with the (psi, theta, phi) of the references. """
+        self.angles = numpy.asarray(angles, dtype=float)
+        self._tree = cKDTree(anglesToVectors(self.angles[:, 1],
+                                             self.angles[:, 2]))
+
+    def getNeighbors(self, theta, phi, angLimit, mirror=True):
+        """ Return a list with the references within angLimit (degrees)
+        of each direction. If mirror is True, the references close to
+        the mirrored direction are also included, as done by AP SHC
+        when checking the mirrored positions.
+        """
+        vectors = anglesToVectors(theta, phi)
+        # Chord distance between unit vectors at angLimit
+        radius = 2 * numpy.sin(numpy.radians(min(angLimit, 180)) / 2)
+        neighbors = self._tree.query_ball_point(vectors, radius)
+        if mirror:
+            mirrored = self._tree.query_ball_point(-vectors, radius)
+            neighbors = [n + m for n, m in zip(neighbors, mirrored)]
+        return neighbors
+
+    def getReachable(self, theta, phi, angLimit, mirror=True):
+        """ Return the sorted indexes of the references that are
+        candidates of at least one of the directions.
+        """
+        neighbors = self.getNeighbors(theta, phi, angLimit, mirror)
+        reachable = set()
+        for n in neighbors:
+            reachable.update(n)
+        return numpy.array(sorted(reachable), dtype=int)
+
+
+def writeAnglesDoc(filename, angles):
+    """ Write the angles in a docfile as written by VO EA. """
+    anglesDoc = SpiderDocFile(filename, 'w+')
+    anglesDoc.writeArray(angles)
+    anglesDoc.close()
+
+
+def readAnglesDoc(filename):
+    anglesDoc = SpiderDocFile(filename)
+    angles = anglesDoc.readArray()[:, :3]
+    anglesDoc.close()
+    return angles
@@ -0,0 +1,128 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+from .utils import SpiderDocFile, SpiderStack, SpiderStackWriter, splitRange
+
+
+def readClassAssignment(filename, numberOfParticles):
+    """ Read the docfile with the (particle, class) rows written by
+    CL KM and return the class of each particle in the stack,
+    0 for the particles not assigned to any class.
+    """
+    doc = SpiderDocFile(filename)
+    data = doc.readArray().astype(int)
+    doc.close()
+    classes = numpy.zeros(numberOfParticles, dtype=int)
+    classes[data[:, 0] - 1] = data[:, 1]
+    return classes
+
+
+def _sumClasses(args):
+    """ Sum the images, and their squares, of each class for the
+    particles first..last (1-based) of the stack.
+    """
+    stackFn, classes, numberOfClasses, first, last, chunkSize = args
+    # classes only has the values of this range of particles
+    offset = first - 1
+    stack = SpiderStack(stackFn)
+    shape = stack[0].shape
+    sums = numpy.zeros((numberOfClasses + 1,) + shape)
+    squares = numpy.zeros_like(sums)
+
+    for i in range(first - 1, last, chunkSize):
+        end = min(i + chunkSize, last)
+        chunkClasses = classes[i-offset:end-offset]
+        # Group the particles of the chunk by class, to sum each
+        # class with a single numpy call
+        order = numpy.argsort(chunkClasses, kind='stable')
+        chunkClasses = chunkClasses[order]
+        images = numpy.asarray(stack[i:end][order], dtype=numpy.float64)
+        bounds = numpy.flatnonzero(numpy.r_[True, chunkClasses[1:] !=
+                                            chunkClasses[:-1]])
+        for start, stop in zip(bounds, numpy.r_[bounds[1:], len(order)]):
+            classImages = images[start:stop]
+            sums[chunkClasses[start]] += classImages.sum(axis=0)
+            squares[chunkClasses[start]] += (classImages ** 2).sum(axis=0)
+
+    stack.close()
+    return sums, squares
+
+
+def computeClassAverages(stackFn, classes, numberOfClasses,
+                         numberOfWorkers=1, chunkSize=1000):
+    """ Compute the average and variance of each class in a single pass
+    over the stack, split in contiguous ranges of particles processed
+    by different processes.
+    Params:
+        classes: the class (1..numberOfClasses) of each particle of the
+            stack, particles with class 0 are not used.
+    Returns the averages, variances and sizes of the classes. As in
+    SPIDER AS R, the variance is normalized by the class size minus one.
+    """
+    classes = numpy.asarray(classes, dtype=int)
+    args = [(stackFn, classes[first-1:last], numberOfClasses,
+             first, last, chunkSize)
+            for first, last in splitRange(len(classes), numberOfWorkers)]
+
+    if len(args) > 1:
+        with ProcessPoolExecutor(len(args)) as executor:
+            results = list(executor.map(_sumClasses, args))
+    else:
+        results = [_sumClasses(a) for a in args]
+
+    sums = sum(r[0] for r in results)[1:]
+    squares = sum(r[1] for r in results)[1:]
+    counts = numpy.bincount(classes, minlength=numberOfClasses + 1)[1:]
+
+    shape = (numberOfClasses,) + (1,) * (sums.ndim - 1)
+    n = counts.reshape(shape).astype(float)
+    averages = sums / numpy.maximum(n, 1)
+    variances = (squares - n * averages ** 2) / numpy.maximum(n - 1, 1)
+
+    return averages, numpy.maximum(variances, 0), counts
+
+
+def writeClassAverages(averages, variances, avgPattern, varPattern):
+    """ Write the average and variance of each class in its own file,
+    e.g. avgPattern='KM/classavg%03d.stk' as done by the Spider scripts.
+    """
+    for classId, (avg, var) in enumerate(zip(averages, variances), 1):
+        for pattern, image in [(avgPattern, avg), (varPattern, var)]:
+            stack = SpiderStackWriter(pattern % classId)
+            stack.write(image)
+            stack.close()
+
+
+def writeClassSizes(filename, counts):
+    """ Write the doc with the (class, size) rows, as kmeans.msa. """
+    doc = SpiderDocFile(filename, 'w+')
+    for classId, count in enumerate(counts, 1):
+        doc.writeValues(classId, count)
+    doc.close()
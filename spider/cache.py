@@ -0,0 +1,145 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import hashlib
+import tempfile
+
+
+def hashFiles(*filenames, **kwargs):
+    """ Return a key from the content of the files and the
+    (sorted) keyword arguments, e.g. the parameters used
+    to generate some outputs from these files.
+    """
+    h = hashlib.sha1()
+    for fn in filenames:
+        with open(fn, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        h.update(b'\0')
+    for k in sorted(kwargs):
+        h.update(('%s=%r;' % (k, kwargs[k])).encode())
+    return h.hexdigest()
+
+
+def getSize(path):
+    """ Size in bytes of a file, or of all files in a folder. """
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, fn))
+               for root, _, files in os.walk(path) for fn in files)
+
+
+def copyPath(src, dst):
+    """ Copy a file or a folder, replacing the destination. """
+    if os.path.isdir(src):
+        shutil.rmtree(dst, ignore_errors=True)
+        shutil.copytree(src, dst)
+    else:
+        if os.path.dirname(dst):
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+        shutil.copyfile(src, dst)
+
+
+class FileCache(object):
+    """ Content-addressed cache of output files (or folders), stored in
+    a folder with one entry per key. Entries are evicted in least
+    recently used order when the cache is bigger than maxSize (in bytes).
+    """
+    def __init__(self, path, maxSize):
+        self.path = path
+        self.maxSize = maxSize
+
+    def _getEntry(self, key):
+        return os.path.join(self.path, key)
+
+    def _getEntryFiles(self, entry):
+        return sorted(os.path.join(entry, fn) for fn in os.listdir(entry))
+
+    def get(self, key, filenames):
+        """ Copy the files of the entry to the given filenames, in
+        the same order they were stored. Return False if the key is
+        not in the cache.
+        """
+        entry = self._getEntry(key)
+        if not os.path.isdir(entry):
+            return False
+
+        cachedFiles = self._getEntryFiles(entry)
+        if len(cachedFiles) != len(filenames):
+            return False
+
+        for cachedFn, fn in zip(cachedFiles, filenames):
+            copyPath(cachedFn, fn)
+        os.utime(entry)  # recently used
+        return True
+
+    def put(self, key, filenames):
+        """ Store a copy of the files for this key and evict the
+        least recently used entries if needed.
+        """
+        size = sum(getSize(fn) for fn in filenames)
+        if size > self.maxSize:
+            return
+
+        entry = self._getEntry(key)
+        if os.path.isdir(entry):
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        # Copy to a temporary folder first, so other runs sharing
+        # the cache never see an incomplete entry
+        tmpEntry = tempfile.mkdtemp(dir=self.path, prefix='.tmp_')
+        for i, fn in enumerate(filenames):
+            copyPath(fn, os.path.join(tmpEntry, '%03d_%s'
+                                      % (i, os.path.basename(fn))))
+        try:
+            os.rename(tmpEntry, entry)
+        except OSError:  # stored at the same time by another run
+            shutil.rmtree(tmpEntry, ignore_errors=True)
+
+        self.evict()
+
+    def evict(self):
+        """ Remove the least recently used entries until the
+        size of the cache is not bigger than maxSize.
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.path):
+            entry = self._getEntry(key)
+            if key.startswith('.') or not os.path.isdir(entry):
+                continue
+            size = getSize(entry)
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+
+        for _, size, entry in sorted(entries):
+            if total <= self.maxSize:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,303 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy
+
+from .constants import CA, IPCA
+from .utils import SpiderDocFile, SpiderStack, SpiderStackWriter
+
+
+# Minimum intensity for CA, lower values require an additive constant
+CA_MIN_INTENSITY = 0.05
+# Coordinate of the reconstituted images, in standard deviations
+# of the image coordinates along each factor
+RECONSTITUTED_SD = 2.0
+
+
+def getCircularMask(dim, radius=-1):
+    """ Boolean mask as Spider MO C, with radius (dim-1)/2 if radius <= 0. """
+    if radius <= 0:
+        radius = (dim - 1) / 2.
+    y, x = numpy.ogrid[:dim, :dim]
+    center = dim // 2
+    return (x - center) ** 2 + (y - center) ** 2 <= radius ** 2
+
+
+def readMask(filename, index=1):
+    """ Boolean mask from the image of a (custom) mask stack. """
+    stack = SpiderStack(filename)
+    mask = stack.getImage(index) > 0.5
+    stack.close()
+    return mask
+
+
+def readParticlesSel(filename):
+    """ Read the particle numbers from a selection doc. """
+    doc = SpiderDocFile(filename)
+    particles = doc.readArray()[:, 0].astype(int)
+    doc.close()
+    return particles
+
+
+def randomizedSvd(matmul, rmatmul, shape, k, oversamples=20,
+                  iterations=4, seed=0):
+    """ Truncated SVD of the matrix A with the given shape, only
+    accessed through the products matmul(W) = A @ W and
+    rmatmul(Q) = A.T @ Q, using a randomized range finder with
+    some (power) iterations to improve the accuracy.
+    Returns U, s, Vt with the first k singular vectors and values.
+    """
+    n, p = shape
+    k = min(k, n, p)
+    size = min(k + oversamples, n, p)
+    rng = numpy.random.default_rng(seed)
+
+    q, _ = numpy.linalg.qr(matmul(rng.standard_normal((p, size))))
+    for _ in range(iterations):
+        z, _ = numpy.linalg.qr(rmatmul(q))
+        q, _ = numpy.linalg.qr(matmul(z))
+
+    u, s, vt = numpy.linalg.svd(rmatmul(q).T, full_matrices=False)
+    return numpy.dot(q, u)[:, :k], s[:k], vt[:k]
+
+
+class MultivariateAnalysis(object):
+    """ In-memory version of CA S in the mda/ca-pca.msa script. The
+    pixels under the mask of all particles are read in chunks into a
+    single matrix, and the first factors of the correspondence (CA) or
+    principal component analysis (PCA, IPCA) are computed with a
+    randomized SVD, without building the centered (or scaled) matrix.
+    """
+    def __init__(self, stackFn, particles, mask, analysisType=CA,
+                 addConstant=0, chunkSize=1000):
+        """
+        Params:
+            particles: the numbers (1-based) of the particles to analyze.
+            mask: boolean mask of the pixels to analyze.
+            addConstant: for CA, the constant added to the images,
+                if 0 it is computed from the minimum intensity.
+        """
+        self.analysisType = analysisType
+        self.mask = numpy.asarray(mask, dtype=bool)
+        self.particles = numpy.asarray(particles, dtype=int)
+        self.addConstant = 0.
+
+        stack = SpiderStack(stackFn)
+        pixels = numpy.flatnonzero(self.mask)
+        self.data = numpy.empty((len(self.particles), len(pixels)),
+                                dtype=numpy.float32)
+        for i in range(0, len(self.particles), chunkSize):
+            images = stack.getImages(self.particles[i:i+chunkSize])
+            self.data[i:i+chunkSize] = images.reshape(len(images), -1)[:, pixels]
+        stack.close()
+
+        if analysisType == CA:
+            if addConstant == 0:
+                minValue = self.data.min()
+                if minValue < CA_MIN_INTENSITY:
+                    addConstant = CA_MIN_INTENSITY - minValue
+            self.addConstant = addConstant
+            self.data += addConstant
+
+    def _dot(self, w):
+        # Keep the products in the data precision to avoid a float64 copy
+        return numpy.dot(self.data, w.astype(numpy.float32)).astype(float)
+
+    def _rdot(self, q):
+        return numpy.dot(self.data.T, q.astype(numpy.float32)).astype(float)
+
+    def _getRowsSum(self, func, chunkSize=1000):
+        """ Apply func to the data in chunks of rows, concatenating
+        the 1D results, to avoid temporary copies of all data.
+        """
+        n = len(self.data)
+        return numpy.concatenate([func(self.data[i:i+chunkSize].astype(float))
+                                  for i in range(0, n, chunkSize)])
+
+    def _computePca(self, numberOfFactors, iterations):
+        n = len(self.data)
+        mean = self.data.mean(axis=0, dtype=float)
+        matmul = lambda w: self._dot(w) - numpy.dot(mean, w)[None, :]
+        rmatmul = lambda q: self._rdot(q) - mean[:, None] * q.sum(axis=0)[None, :]
+        u, s, vt = randomizedSvd(matmul, rmatmul, self.data.shape,
+                                 numberOfFactors, iterations=iterations)
+
+        self.mean = mean
+        self.eigenvalues = s ** 2 / n
+        self.imageDistances = self._getRowsSum(
+            lambda x: ((x - mean) ** 2).sum(axis=1))
+        self.trace = self.imageDistances.sum() / n
+        self.imageWeights = numpy.ones(n)
+        self.imageCoords = u * s
+        self.pixelWeights = numpy.ones(len(mean))
+        self.pixelCoords = vt.T * s / numpy.sqrt(n)
+        self.pixelDistances = (self.pixelCoords ** 2).sum(axis=1)
+        self.eigenvectors = vt
+
+    def _computeCa(self, numberOfFactors, iterations):
+        total = self.data.sum(dtype=float)
+        r = self.data.sum(axis=1, dtype=float) / total  # row masses
+        c = self.data.sum(axis=0, dtype=float) / total  # column masses
+        sr, sc = numpy.sqrt(r), numpy.sqrt(c)
+
+        # S = Dr^-1/2 (P - r c') Dc^-1/2, with P = data / total
+        def matmul(w):
+            w = w / sc[:, None]
+            return (self._dot(w) / total - r[:, None] * numpy.dot(c, w)) / sr[:, None]
+
+        def rmatmul(q):
+            q = q / sr[:, None]
+            return (self._rdot(q) / total - c[:, None] * numpy.dot(r, q)) / sc[:, None]
+
+        u, s, vt = randomizedSvd(matmul, rmatmul, self.data.shape,
+                                 numberOfFactors, iterations=iterations)
+
+        self.total = total
+        self.eigenvalues = s ** 2
+        # Chi-squared distance of each image profile to the average profile
+        self.imageDistances = self._getRowsSum(
+            lambda x: (((x / x.sum(axis=1)[:, None]) - c) ** 2 / c).sum(axis=1))
+        self.trace = (r * self.imageDistances).sum()
+        self.imageWeights = r
+        self.imageCoords = u * s / sr[:, None]
+        self.pixelWeights = c
+        self.pixelCoords = vt.T * s / sc[:, None]
+        self.pixelDistances = (self.pixelCoords ** 2).sum(axis=1)
+        self.eigenvectors = vt
+
+    def compute(self, numberOfFactors):
+        """ Compute the eigenvalues and the coordinates of images and
+        pixels in the first factors. IPCA uses more iterations of
+        the randomized SVD than PCA.
+        """
+        if self.analysisType == CA:
+            self._computeCa(numberOfFactors, iterations=7)
+        else:
+            iterations = 10 if self.analysisType == IPCA else 7
+            self._computePca(numberOfFactors, iterations)
+
+    def getNumberOfFactors(self):
+        return len(self.eigenvalues)
+
+    def _getImage(self, values):
+        image = numpy.zeros(self.mask.shape, dtype=numpy.float32)
+        image[self.mask] = values
+        return image
+
+    def getEigenImages(self):
+        """ Pixel coordinates (CA) or eigenvectors (PCA) of each factor. """
+        values = (self.pixelCoords.T if self.analysisType == CA
+                  else self.eigenvectors)
+        return [self._getImage(v) for v in values]
+
+    def getReconstitutedImages(self):
+        """ Images reconstituted at plus (top) and minus (bottom)
+        RECONSTITUTED_SD standard deviations along each factor.
+        """
+        images = []
+        for k, eigenvalue in enumerate(self.eigenvalues):
+            coord = RECONSTITUTED_SD * numpy.sqrt(eigenvalue)
+            pair = []
+            for sign in [1, -1]:
+                if self.analysisType == CA:
+                    # Reconstitution formula of the image profile
+                    c = self.pixelWeights
+                    g = self.pixelCoords[:, k]
+                    profile = c * (1 + sign * coord * g / numpy.sqrt(eigenvalue))
+                    values = (profile * self.total / len(self.data)
+                              - self.addConstant)
+                else:
+                    values = self.mean + sign * coord * self.eigenvectors[k]
+                pair.append(self._getImage(values))
+            margin = numpy.zeros((1, self.mask.shape[1]), dtype=numpy.float32)
+            images.append(numpy.vstack([pair[0], margin, pair[1]]))
+        return images
+
+    def _getHeader(self, numberOfRows, numberOfColumns):
+        ny, nx = self.mask.shape
+        return ' %d %d %d %d %d %d\n' % (numberOfRows, numberOfColumns,
+                                         nx, ny, self.mask.sum(),
+                                         self.analysisType + 1)
+
+    def _writeCoords(self, filename, coords, weights, distances, numbers,
+                     offset=0, chunkSize=1000):
+        """ Write a coordinates file: a header line with the number of
+        rows and coordinates (then nx, ny, number of pixels and analysis
+        type), and one line per row with its coordinates (minus offset),
+        weight, distance to the center, number and active flag.
+        """
+        n, k = coords.shape
+        fmt = ['%13.6e'] * (k + 2) + ['%8d', '%2d']
+        with open(filename, 'w') as f:
+            f.write(self._getHeader(n, k))
+            for i in range(0, n, chunkSize):
+                rows = slice(i, i + chunkSize)
+                numpy.savetxt(f, numpy.column_stack(
+                    [coords[rows] - offset, weights[rows], distances[rows],
+                     numbers[rows], numpy.ones(len(numbers[rows]))]),
+                    fmt=fmt)
+
+    def writeImc(self, filename):
+        """ Write the image coordinates (IMC) file. """
+        self._writeCoords(filename, self.imageCoords, self.imageWeights,
+                          self.imageDistances, self.particles)
+
+    def writePix(self, filename):
+        """ Write the pixel coordinates (PIX) file. """
+        self._writeCoords(filename, self.pixelCoords, self.pixelWeights,
+                          self.pixelDistances,
+                          numpy.flatnonzero(self.mask.ravel()) + 1)
+
+    def writeSeq(self, filename):
+        """ Write the pixel values under the mask of all images (SEQ),
+        with the same layout as the IMC file, so it can also be used
+        as input of the classifications.
+        """
+        self._writeCoords(filename, self.data, numpy.ones(len(self.data)),
+                          numpy.zeros(len(self.data)), self.particles,
+                          offset=self.addConstant)
+
+    def writeEig(self, filename):
+        """ Write the eigenvalues (EIG) file: a header line with the
+        number of factors, sum of weights, trace, analysis type and
+        number of images, and one line per factor with its eigenvalue,
+        percentage of the trace and cumulative percentage.
+        """
+        percents = 100. * self.eigenvalues / self.trace
+        with open(filename, 'w') as f:
+            f.write(' %d %13.6e %13.6e %d %d\n'
+                    % (self.getNumberOfFactors(), self.imageWeights.sum(),
+                       self.trace, self.analysisType + 1, len(self.data)))
+            numpy.savetxt(f, numpy.column_stack([self.eigenvalues, percents,
+                                                 numpy.cumsum(percents)]),
+                          fmt='%13.6e')
+
+    def writeImages(self, filename, images):
+        """ Write the eigenimages or reconstituted images in a stack. """
+        stack = SpiderStackWriter(filename)
+        for img in images:
+            stack.write(img)
+        stack.close()
@@ -31,6 +31,8 @@ SPMAN_DIR = 'SPMAN_DIR'
 SPBIN_DIR = 'SPBIN_DIR'
 SPIDER = 'SPIDER'
 SPIDER_MPI = 'SPIDER_MPI'
+# Size (GB) of the cache of script outputs, 0 to disable it
+SPIDER_CACHE_SIZE = 'SPIDER_CACHE_SIZE'
 
 # spider documentation url
 SPIDER_DOCS = 'https://spider.wadsworth.org/spider_doc/spider/docs/man/'
@@ -55,6 +57,10 @@ FILTER_RAISEDCOS = 4
 FILTER_LOWPASS = 0
 FILTER_HIGHPASS = 1
 
+# Filtering engines
+ENGINE_SPIDER = 0
+ENGINE_NUMPY = 1
+
 # CA-PCA protocol
 CA = 0
 PCA = 1
@@ -73,6 +79,11 @@ BP_3F = 1
 DEF_GROUPS = 0
 GOLD_STD = 1
 
+# Iteration phases of refine.pam (projmatch with defocus groups)
+ITER_ALL = 0
+ITER_PREPARE = 1
+ITER_MERGE = 2
+
 # Backprojection method (projmatch protocol)
 BP_CG = 0
 # BP_3F = 1
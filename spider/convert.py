@@ -25,14 +25,13 @@
 # **************************************************************************
 
 import numpy
-from os.path import splitext, split
 
 from pwem.objects import Transform
 from pwem.constants import NO_INDEX, ALIGN_2D, ALIGN_3D, ALIGN_PROJ
+from pwem.emlib.image import ImageHandler
 import pwem.convert.transformations as transformations
-from pyworkflow.utils.path import moveFile
 
-from .utils import SpiderDocFile, runTemplate
+from .utils import SpiderDocFile, SpiderStackWriter
 from .constants import (SHIFTX, SHIFTY, ANGLE_PSI,
                         ANGLE_THE, ANGLE_PHI, FLIP)
 
@@ -66,32 +65,33 @@ def writeSetOfImages(imgSet, stackFn, selFn):
         selFn: the filename of the Spider selection file.
     """
     doc = SpiderDocFile(selFn, 'w+')
+    stack = SpiderStackWriter(stackFn)
+    ih = ImageHandler()
+    applyTransform = imgSet.hasAlignment2D()
 
-    for i in range(imgSet.getSize()):
-        doc.writeValues(i+1)
+    for img in imgSet.iterItems(orderBy='id', direction='ASC'):
+        stack.write(readImageData(img, ih, applyTransform))
 
-    imgSet.writeStack(stackFn, applyTransform=True)
+    doc.writeArray(numpy.arange(1, stack.getSize() + 1))
+    stack.close()
     doc.close()
 
-    convertEndian(stackFn, imgSet.getSize())
 
-
-def convertEndian(stackFn, stackSize):
-    """ Convert the stack file generated by Xmipp
-    to one that Spider likes more.
+def readImageData(img, ih, applyTransform=False):
+    """ Read the image data as a numpy array,
+    optionally applying the image transformation.
     Params:
-        stackFn: the filename of the images stack
-        stackSize: the number of particles in the stack
+        img: the Image object to read.
+        ih: the ImageHandler instance used to read the image.
+        applyTransform: whether to apply the image transform or not.
     """
-    fn, ext = splitext(stackFn)
-    fnDir, fnBase = split(fn)
-    # Change to BigEndian
-    runTemplate('../cp_endian.spi', ext[1:],
-                {'[particles]': fnBase + '@******',
-                 '[particles_big]': fnBase + '_big@******',
-                 '[numberOfParticles]': stackSize
-                 }, cwd=fnDir)
-    moveFile(fn + '_big' + ext, stackFn)
+    image = ih.read(img.getLocation())
+    transform = img.getTransform()
+
+    if applyTransform and transform is not None:
+        image.applyTransforMatScipion(transform.getMatrixAsList())
+
+    return image.getData()
     
     
 # ------------- Geometry conversions ---------------------------------------
@@ -199,3 +199,170 @@ def alignmentToRow(alignment, alignmentRow, alignType):
 
 def createItemMatrix(item, row, align):
     item.setTransform(rowToAlignment(row, alignType=align))
+
+
+# ------------- Batch geometry conversions ---------------------------------
+# The following functions are vectorized versions of the ones above,
+# working on stacks of matrices (N, 4, 4) or arrays of values (N,)
+
+EPS = numpy.finfo(float).eps * 4.0  # same as in transformations module
+
+
+def eulerMatricesZYZ(angles):
+    """ Same as transformations.euler_matrix(ai, aj, ak, 'szyz')
+    for an array of angles (in radians) of shape (N, 3).
+    """
+    # 'szyz' means parity, so all angles are negated
+    ai, aj, ak = [-a for a in numpy.asarray(angles, dtype=float).T]
+    si, sj, sk = numpy.sin(ai), numpy.sin(aj), numpy.sin(ak)
+    ci, cj, ck = numpy.cos(ai), numpy.cos(aj), numpy.cos(ak)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    M = numpy.zeros((len(ai), 4, 4))
+    # i, j, k axis are z, y, x
+    M[:, 2, 2] = cj
+    M[:, 2, 1] = sj * si
+    M[:, 2, 0] = sj * ci
+    M[:, 1, 2] = sj * sk
+    M[:, 1, 1] = -cj * ss + cc
+    M[:, 1, 0] = -cj * cs - sc
+    M[:, 0, 2] = -sj * ck
+    M[:, 0, 1] = cj * sc + cs
+    M[:, 0, 0] = cj * cc - ss
+    M[:, 3, 3] = 1.0
+
+    return M
+
+
+def eulerFromMatricesZYZ(matrices):
+    """ Same as transformations.euler_from_matrix(M, 'szyz')
+    for a stack of matrices. Return an array of shape (N, 3).
+    """
+    M = numpy.asarray(matrices, dtype=float)
+    sy = numpy.sqrt(M[:, 2, 1] ** 2 + M[:, 2, 0] ** 2)
+    regular = sy > EPS
+
+    ax = numpy.where(regular, numpy.arctan2(M[:, 2, 1], M[:, 2, 0]),
+                     numpy.arctan2(-M[:, 1, 0], M[:, 1, 1]))
+    ay = numpy.arctan2(sy, M[:, 2, 2])
+    az = numpy.where(regular, numpy.arctan2(M[:, 1, 2], -M[:, 0, 2]), 0.0)
+
+    return -numpy.stack([ax, ay, az], axis=1)
+
+
+def geometryFromMatrices(matrices, inverseTransform):
+    """ Vectorized version of geometryFromMatrix.
+    Return shifts and angles as arrays of shape (N, 3).
+    """
+    if inverseTransform:
+        matrices = numpy.linalg.inv(matrices)
+        shifts = -matrices[:, :3, 3]
+    else:
+        shifts = matrices[:, :3, 3].copy()
+    angles = -numpy.rad2deg(eulerFromMatricesZYZ(matrices))
+    return shifts, angles
+
+
+def matricesFromGeometry(shifts, angles, inverseTransform):
+    """ Vectorized version of matrixFromGeometry,
+    shifts and angles should be arrays of shape (N, 3).
+    """
+    M = eulerMatricesZYZ(-numpy.deg2rad(angles))
+    if inverseTransform:
+        M[:, :3, 3] = -numpy.asarray(shifts)[:, :3]
+        M = numpy.linalg.inv(M)
+    else:
+        M[:, :3, 3] = numpy.asarray(shifts)[:, :3]
+
+    return M
+
+
+def rowsToAlignments(alignmentRows, alignType):
+    """ Vectorized version of rowToAlignment.
+    Params:
+        alignmentRows: dict with the same keys as rowToAlignment rows
+            ('ANGLE_PSI', 'SHIFTX'...) but with arrays as values.
+        alignType: the type of alignment (ALIGN_2D, ALIGN_3D or ALIGN_PROJ)
+    Return a stack of transformation matrices of shape (N, 4, 4).
+    """
+    psi = numpy.asarray(alignmentRows['ANGLE_PSI'], dtype=float)
+    n = len(psi)
+    angles = numpy.zeros((n, 3))
+    shifts = numpy.zeros((n, 3))
+    angles[:, 2] = psi
+    shifts[:, 0] = alignmentRows['SHIFTX']
+    shifts[:, 1] = alignmentRows['SHIFTY']
+    if alignType != ALIGN_2D:
+        angles[:, 0] = alignmentRows['ANGLE_PHI']
+        angles[:, 1] = alignmentRows['ANGLE_THE']
+
+    return matricesFromGeometry(shifts, angles, inverseTransform=True)
+
+
+def alignmentsToRows(matrices, alignType):
+    """ Vectorized version of alignmentToRow.
+    Params:
+        matrices: stack of transformation matrices of shape (N, 4, 4).
+        alignType: the type of alignment (ALIGN_2D, ALIGN_3D or ALIGN_PROJ)
+    Return a dict with the same keys as alignmentToRow (SHIFTX, SHIFTY...)
+    but with arrays as values.
+    """
+    is2D = alignType == ALIGN_2D
+    inverseTransform = alignType == ALIGN_PROJ
+    matrices = numpy.array(matrices, dtype=float).reshape(-1, 4, 4)
+
+    if is2D:
+        flip = numpy.linalg.det(matrices[:, 0:2, 0:2]) < 0
+        matrices[flip, 0, :2] *= -1.
+        matrices[flip, 2, 2] = 1.
+    else:
+        flip = numpy.linalg.det(matrices[:, 0:3, 0:3]) < 0
+        matrices[flip, 0, :4] *= -1.
+        if alignType == ALIGN_3D:
+            matrices[flip, 3, 3] = 1.
+
+    shifts, angles = geometryFromMatrices(matrices, inverseTransform)
+    alignmentRows = {SHIFTX: -shifts[:, 0],
+                     SHIFTY: -shifts[:, 1]}
+
+    if is2D:
+        alignmentRows[ANGLE_PSI] = angles[:, 0] + angles[:, 2]
+    else:
+        alignmentRows[ANGLE_PHI] = angles[:, 0]
+        alignmentRows[ANGLE_THE] = angles[:, 1]
+        alignmentRows[ANGLE_PSI] = -angles[:, 2]
+
+    alignmentRows[FLIP] = numpy.where(flip, -1, 1)
+
+    return alignmentRows
+
+
+def writeAlignmentDoc(docFn, matrices):
+    """ Write the Spider alignment docfile used for projection matching
+    and reconstruction.
+    Params:
+        docFn: the filename of the docfile.
+        matrices: list with the projection matrix of each image,
+            or None if the image has no alignment.
+    """
+    n = len(matrices)
+    hasAlignment = numpy.array([m is not None for m in matrices], dtype=bool)
+    identity = numpy.identity(4)
+    stack = numpy.array([identity if m is None else m for m in matrices])
+    rows = alignmentsToRows(stack, ALIGN_PROJ)
+
+    # PSI, THE, PHI, REF#, EXP#, CUM.{ROT, SX, SY}, NPROJ, DIFF, CCROT, ROT, SX, SY, MIR-CC
+    values = numpy.zeros((n, 15))
+    for col, key in [(1, ANGLE_THE), (2, ANGLE_PHI), (5, ANGLE_PSI),
+                     (6, SHIFTX), (7, SHIFTY)]:
+        values[hasAlignment, col] = rows[key][hasAlignment]
+    values[:, 4] = numpy.arange(1, n + 1)
+
+    doc = SpiderDocFile(docFn, 'w+')
+    doc.writeComment(docFn)
+    header = ['KEY', 'PSI', 'THE', 'PHI', 'REF#', 'EXP#', 'CUM.{ROT',
+              'SX', 'SY}', 'NPROJ', 'DIFF', 'CCROT', 'ROT', 'SX', 'SY', 'MIR-CC']
+    doc.writeHeader(header)
+    doc.writeArray(values)
+    doc.close()
@@ -0,0 +1,198 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy
+import scipy.fft
+
+from .constants import (FILTER_TOPHAT, FILTER_SPACE_REAL, FILTER_FERMI,
+                        FILTER_BUTTERWORTH, FILTER_RAISEDCOS,
+                        FILTER_LOWPASS, FILTER_HIGHPASS)
+
+
+# Constants used by Spider FQ to derive the Butterworth order and radius
+BUTTERWORTH_EPS = 0.882
+BUTTERWORTH_AA = 10.624
+
+
+def getFrequencies(shape):
+    """ Return the digital frequency (0 - 0.5) of each coefficient
+    of the half-complex Fourier transform (rfftn) of an array
+    with the given shape (y, x) or (z, y, x).
+    """
+    axes = [numpy.fft.fftfreq(n) for n in shape[:-1]]
+    axes.append(numpy.fft.rfftfreq(shape[-1]))
+    grids = numpy.meshgrid(*axes, indexing='ij', sparse=True)
+
+    return numpy.sqrt(sum(g ** 2 for g in grids))
+
+
+def getFilterResponse(freq, filterType, filterMode=FILTER_LOWPASS,
+                      filterRadius=0.12, lowFreq=0.1, highFreq=0.2,
+                      temperature=0.3):
+    """ Return the response of the Spider FQ filters at the given
+    digital frequencies, using the same filter parameters as
+    the protocol and the wizard.
+    """
+    if filterType == FILTER_TOPHAT:
+        response = (freq <= filterRadius).astype(numpy.float32)
+    elif filterType == FILTER_SPACE_REAL:
+        response = numpy.exp(-freq ** 2 / (2 * filterRadius ** 2))
+    elif filterType == FILTER_FERMI:
+        # Avoid overflow warnings for very low temperatures
+        x = numpy.clip((freq - filterRadius) / temperature, -50, 50)
+        response = 1. / (1. + numpy.exp(x))
+    elif filterType == FILTER_BUTTERWORTH:
+        order = (2. * numpy.log10(BUTTERWORTH_EPS /
+                                  numpy.sqrt(BUTTERWORTH_AA ** 2 - 1.)) /
+                 numpy.log10(lowFreq / highFreq))
+        radius = lowFreq / BUTTERWORTH_EPS ** (2. / order)
+        response = 1. / numpy.sqrt(1. + (freq / radius) ** order)
+    elif filterType == FILTER_RAISEDCOS:
+        x = numpy.clip((freq - lowFreq) / (highFreq - lowFreq), 0, 1)
+        response = 0.5 * (numpy.cos(numpy.pi * x) + 1.)
+    else:
+        raise ValueError("Unknown filter type: %s" % filterType)
+
+    if filterMode == FILTER_HIGHPASS:
+        response = 1. - response
+
+    return response.astype(numpy.float32)
+
+
+class FourierFilter(object):
+    """ Keep the Fourier transform of a batch of images, so they can
+    be filtered many times (e.g. while previewing different filter
+    parameters) paying the forward FFT only once.
+    Params:
+        images: numpy array whose last ndim axes are the images,
+            e.g. (n, y, x) for a stack or (z, y, x) for a volume with ndim=3
+        usePadding: as Spider FQ, pad with the average value to twice the
+            size, otherwise filter as FQ NP
+        ndim: number of dimensions of each image
+        workers: number of threads used to compute the FFTs
+    """
+    def __init__(self, images, usePadding=True, ndim=2, workers=1):
+        images = numpy.asarray(images, dtype=numpy.float32)
+        self._axes = tuple(range(-ndim, 0))
+        self._workers = workers
+        shape = images.shape[-ndim:]
+        self._window = (Ellipsis,) + tuple(slice(0, n) for n in shape)
+
+        if usePadding:
+            self._fftShape = tuple(2 * n for n in shape)
+            data = numpy.empty(images.shape[:-ndim] + self._fftShape,
+                               dtype=numpy.float32)
+            data[...] = images.mean(axis=self._axes, keepdims=True)
+            data[self._window] = images
+        else:
+            self._fftShape = shape
+            data = images
+
+        self._ft = scipy.fft.rfftn(data, axes=self._axes, workers=workers)
+        self._freq = getFrequencies(self._fftShape)
+
+    def filter(self, filterType, filterMode=FILTER_LOWPASS, **kwargs):
+        """ Return the images filtered with the given filter as a
+        float32 array of the same shape as the input images.
+        kwargs are filterRadius, lowFreq, highFreq and temperature,
+        as expected by getFilterResponse.
+        """
+        ft = self._ft * getFilterResponse(self._freq, filterType,
+                                          filterMode, **kwargs)
+        data = scipy.fft.irfftn(ft, s=self._fftShape, axes=self._axes,
+                                workers=self._workers)
+
+        return data[self._window].astype(numpy.float32)
+
+
+def filterImages(images, filterType, filterMode=FILTER_LOWPASS,
+                 usePadding=True, ndim=2, workers=1, **kwargs):
+    """ Apply a Spider FQ (or FQ NP if not usePadding) filter to a batch
+    of images in memory, without running Spider.
+    See FourierFilter for the meaning of the parameters.
+    """
+    fourierFilter = FourierFilter(images, usePadding, ndim, workers)
+
+    return fourierFilter.filter(filterType, filterMode, **kwargs)
+
+
+class CustomMask(object):
+    """ In-memory version of the mda/custommask.msa script.
+    The result of each step is kept together with the parameters it
+    depends on, so changing only the last parameters (e.g. the mask
+    threshold) only recomputes the last steps.
+    """
+    def __init__(self, image, usePadding=True):
+        self.image = numpy.asarray(image, dtype=numpy.float32)
+        # Spider FS statistics of the input image
+        self._avg = self.image.mean()
+        self._sd = self.image.std(ddof=1)
+        self._usePadding = usePadding
+        self._inputFilter = FourierFilter(self.image, usePadding)
+        self._steps = {}
+
+    def _step(self, name, key, func, *args):
+        """ Return the result of a step, computing it only if the
+        parameters in key changed since the last call.
+        """
+        lastKey, result = self._steps.get(name, (None, None))
+
+        if key != lastKey:
+            result = func(*args)
+            self._steps[name] = (key, result)
+
+        return result
+
+    def _lowPass(self, fourierFilter, radius):
+        return fourierFilter.filter(FILTER_SPACE_REAL, FILTER_LOWPASS,
+                                    filterRadius=radius)
+
+    def _threshold(self, image, threshold):
+        """ Binary mask as Spider TH M with (B)elow option. """
+        return (image > threshold).astype(numpy.float32)
+
+    def compute(self, filterRadius1, sdFactor, filterRadius2, maskThreshold):
+        """ Return the 7 images written by the script in the output
+        mask stack: filtered image, thresholded, filtered mask,
+        final mask, mask * image, inverted mask and inverted mask * image.
+        """
+        r1, sd, r2, th = [float(v) for v in (filterRadius1, sdFactor,
+                                             filterRadius2, maskThreshold)]
+        filtered = self._step('filtered', r1, self._lowPass,
+                              self._inputFilter, r1)
+        thresholded = self._step('thresholded', (r1, sd), self._threshold,
+                                 filtered, self._avg + self._sd * sd)
+        thresholdedFilter = self._step('thresholdedFilter', (r1, sd),
+                                       FourierFilter, thresholded,
+                                       self._usePadding)
+        filteredMask = self._step('filteredMask', (r1, sd, r2),
+                                  self._lowPass, thresholdedFilter, r2)
+        mask = self._step('mask', (r1, sd, r2, th), self._threshold,
+                          filteredMask, th)
+        inverted = 1. - mask
+
+        return [filtered, thresholded, filteredMask, mask,
+                mask * self.image, inverted, inverted * self.image]
@@ -0,0 +1,79 @@
+# **************************************************************************
+# *
+# * Authors:     J.M. De la Rosa Trevin (delarosatrevin@scilifelab.se)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+from .utils import SpiderDocFile, splitRange
+
+
+# Columns of the group manifest, after the key
+MANIFEST_COLUMNS = ['group', 'particles', 'defocus', 'first', 'last']
+
+
+def getNumberOfGroups(numberOfWorkers, groupsPerWorker=1, minGroups=2):
+    """ Return the number of groups for the given workers, so each
+    worker processes the same number of groups.
+    """
+    numberOfWorkers = max(1, numberOfWorkers)
+    groupsPerWorker = max(1, groupsPerWorker)
+    return max(minGroups, numberOfWorkers * groupsPerWorker)
+
+
+def balanceGroups(numberOfParticles, numberOfGroups):
+    """ Split the particles in contiguous groups whose sizes differ
+    at most in one particle. Since all particles have the same box
+    size, this also balances the time spent in each group.
+    Returns a list of (first, last) particle indexes (1-based).
+    """
+    return splitRange(numberOfParticles, numberOfGroups)
+
+
+def writeGroupManifest(filename, groups):
+    """ Write the group manifest. Each group is a dict with the
+    MANIFEST_COLUMNS keys, missing values are written as 0.
+    The first columns (group, particles, defocus) are the ones
+    expected by the Spider scripts.
+    """
+    manifest = SpiderDocFile(filename, 'w+')
+    for group in groups:
+        manifest.writeValues(*[group.get(k, 0) for k in MANIFEST_COLUMNS])
+    manifest.close()
+
+
+def readGroupManifest(filename):
+    """ Read the groups from the manifest written by writeGroupManifest.
+    Old manifests may have less columns, missing values are set to 0.
+    """
+    manifest = SpiderDocFile(filename)
+    groups = []
+    for values in manifest:
+        if not values:  # skip empty lines
+            continue
+        values = list(values) + [0] * (len(MANIFEST_COLUMNS) - len(values))
+        group = dict(zip(MANIFEST_COLUMNS, values))
+        for k in ['group', 'particles', 'first', 'last']:
+            group[k] = int(group[k])
+        groups.append(group)
+    manifest.close()
+    return groups
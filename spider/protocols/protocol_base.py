@@ -24,10 +24,14 @@
 # *
 # **************************************************************************
 
+from os.path import abspath, dirname, join
+
 from pwem.protocols import EMProtocol
 
 from .. import Plugin
-from ..utils import runTemplate
+from ..constants import SPIDER_CACHE_SIZE
+from ..cache import FileCache
+from ..utils import runTemplate, SpiderProgressMonitor
 from ..convert import writeSetOfImages
 
 
@@ -63,22 +67,49 @@ class SpiderProtocol(EMProtocol):
     def getScript(self):
         return getattr(self, '_script', None)
     
-    def runTemplate(self, inputScript, ext, paramsDict, nummpis=1):
+    def monitorProgress(self, script):
+        """ Return a monitor that writes the progress of the script
+        run in logs/progress.jsonl, to be used as context manager.
+        """
+        # Absolute paths, since the script may run in other folder
+        return SpiderProgressMonitor(abspath(self.getStdoutLog()),
+                                     abspath(self._getLogsPath('progress.jsonl')),
+                                     script=script)
+
+    def _getProjectTmpPath(self, *paths):
+        """ Path in the project Tmp folder, shared by all runs. """
+        # The working dir of the run is inside the project Runs folder
+        projPath = dirname(dirname(abspath(self.getWorkingDir())))
+        return join(projPath, 'Tmp', *paths)
+
+    def getOutputsCache(self):
+        """ Return the cache of script outputs, or None if the
+        SPIDER_CACHE_SIZE (GB) variable is not set.
+        """
+        cacheSize = float(Plugin.getVar(SPIDER_CACHE_SIZE) or 0)
+        if cacheSize <= 0:
+            return None
+        return FileCache(self._getProjectTmpPath('spider_outputs'),
+                         maxSize=cacheSize * 1024 ** 3)
+
+    def runTemplate(self, inputScript, ext, paramsDict, nummpis=1,
+                    inputs=(), outputs=()):
         """ This function will create a valid Spider script
         by copying the template and replacing the values in dictionary.
         After the new file is read, the Spider interpreter is invoked.
+        If the outputs (relative to the working dir) are declared,
+        they may be restored from the outputs cache instead.
         """
-        self._enterWorkingDir()
+        cache = self.getOutputsCache() if outputs else None
 
-        log = getattr(self, '_log', None)
-        mpiFlag = True if nummpis > 1 else False
-        program = Plugin.getProgram(mpiFlag)
-        runTemplate(inputScript, ext, paramsDict, nummpis=nummpis,
-                    program=program, log=log)
-        self._leaveWorkingDir()
-    
-        f = open(self.getLogPaths()[0], 'r')
-        for line in f.readlines():
-            if 'FATAL ERROR ENCOUNTERED IN BATCH MODE' in line:
-                raise RuntimeError('Spider script error!')
-        f.close()
+        with self.monitorProgress(inputScript):
+            self._enterWorkingDir()
+            try:
+                log = getattr(self, '_log', None)
+                mpiFlag = True if nummpis > 1 else False
+                program = Plugin.getProgram(mpiFlag)
+                runTemplate(inputScript, ext, paramsDict, nummpis=nummpis,
+                            program=program, log=log, inputs=inputs,
+                            outputs=outputs, cache=cache)
+            finally:
+                self._leaveWorkingDir()
@@ -28,10 +28,14 @@ from os.path import join
 
 from pyworkflow.protocol.params import (IntParam, PointerParam,
                                         EnumParam, FloatParam)
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from pyworkflow.constants import PROD
+from pyworkflow.utils.path import makePath
 from pwem.emlib.image import ImageHandler
 
-from ..constants import CA
+from ..constants import CA, ENGINE_SPIDER, ENGINE_NUMPY
+from ..capca import (MultivariateAnalysis, getCircularMask, readMask,
+                     readParticlesSel)
 from ..objects import PcaFile
 from .protocol_base import SpiderProtocol
 
@@ -72,6 +76,7 @@ class SpiderProtCAPCA(SpiderProtocol):
                         # TO DO: read tags in case filenames change in SPIDER procedure
                         'imcFile': caFilePrefix + 'IMC',
                         'seqFile': caFilePrefix + 'SEQ',
+                        'pixFile': caFilePrefix + 'PIX',
                         'eigFile': caFilePrefix + 'EIG',
                         'eigenimages': join(self._caDir, 'stkeigenimg'),
                         'reconstituted': join(self._caDir, 'stkreconstituted')
@@ -118,6 +123,17 @@ class SpiderProtCAPCA(SpiderProtocol):
                       condition='maskType==1',
                       pointerClass='Mask', 
                       help="Select a mask file")
+        form.addParam('engine', EnumParam, choices=['Spider', 'NumPy'],
+                      default=ENGINE_SPIDER, expertLevel=LEVEL_ADVANCED,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Analysis engine',
+                      help='With *Spider* the analysis is done by CA S in '
+                           'SPIDER, which diagonalizes the full '
+                           'pixel covariance matrix.\n'
+                           'With *NumPy* it is done by Scipion with a '
+                           'randomized SVD that only computes the requested '
+                           'factors, much faster for big images or many '
+                           'particles. The factor maps are not generated.')
 
         form.addParallelSection(threads=1, mpi=0)
         
@@ -133,7 +149,9 @@ class SpiderProtCAPCA(SpiderProtocol):
         else:
             self.maskImage.set(None)
             
-        self._insertFunctionStep('capcaStep', self.analysisType.get(), 
+        stepName = ('capcaNumpyStep' if self.engine == ENGINE_NUMPY
+                    else 'capcaStep')
+        self._insertFunctionStep(stepName, self.analysisType.get(),
                                  self.numberOfFactors.get(), self.maskType.get())
         self._insertFunctionStep('createOutputStep')
         
@@ -166,7 +184,39 @@ class SpiderProtCAPCA(SpiderProtocol):
                              '[nummps]': self.numberOfThreads.get()
                              })
                    
-        self.runTemplate('mda/ca-pca.msa', self.getExt(), self._params)
+        ext = self.getExt()
+        inputs = [self._params[k] + '.' + ext
+                  for k in ['particles', 'particlesSel']]
+        if maskType > 0:
+            inputs.append(self._params['mask'] + '.' + ext)
+
+        self.runTemplate('mda/ca-pca.msa', ext, self._params,
+                         inputs=inputs, outputs=[self._caDir])
+
+    def capcaNumpyStep(self, analysisType, numberOfFactors, maskType):
+        """ Same analysis as capcaStep, computing only the requested
+        factors with a randomized SVD instead of running CA S.
+        """
+        if maskType > 0:
+            mask = readMask(self._getFileName('mask'))
+        else:
+            dim = self.inputParticles.get().getDimensions()[0]
+            mask = getCircularMask(dim, self.radius.get())
+
+        mda = MultivariateAnalysis(self._getFileName('particles'),
+                                   readParticlesSel(self._getFileName('particlesSel')),
+                                   mask, analysisType, self.addConstant.get())
+        mda.compute(numberOfFactors)
+
+        makePath(self._getPath(self._caDir))
+        mda.writeImc(self._getFileName('imcFile'))
+        mda.writeSeq(self._getFileName('seqFile'))
+        mda.writePix(self._getFileName('pixFile'))
+        mda.writeEig(self._getFileName('eigFile'))
+        mda.writeImages(self._getFileName('eigenimages'),
+                        mda.getEigenImages())
+        mda.writeImages(self._getFileName('reconstituted'),
+                        mda.getReconstitutedImages())
         
     def createOutputStep(self):
         # Generate outputs
@@ -24,15 +24,16 @@
 # *
 # **************************************************************************
 
-from os.path import basename
+from os.path import basename, exists
+
+import numpy
 
 from pwem.protocols import ProtClassify2D
-from pwem.emlib.image import ImageHandler
 from pyworkflow.protocol.params import PointerParam, IntParam
 from pyworkflow.utils import removeExt, copyFile
 import pyworkflow.utils.graph as graph
 
-from ..utils import SpiderDocFile
+from ..utils import SpiderDocFile, SpiderStack, SpiderStackWriter
 from .protocol_base import SpiderProtocol
 
 
@@ -138,7 +139,8 @@ class SpiderProtClassifyCluster(SpiderProtClassify):
 
     # --------------------------- STEPS functions -----------------------------
     def createOutputStep(self):
-        self.buildDendrogram(True)
+        root = self.buildDendrogram(True)
+        writeDendrogram(self._getDendrogramFile(), root)
          
     # --------------------------- UTILS functions -----------------------------
     def _fillClassesFromNodes(self, classes2D, nodeList):
@@ -199,6 +201,27 @@ class SpiderProtClassifyCluster(SpiderProtClassify):
                               updateItemCallback=updateItem,
                               itemDataIterator=iter(particlesRange))
 
+    def _getDendrogramFile(self):
+        return self._getExtraPath('dendrogram.npz')
+
+    def getDendrogram(self):
+        """ Return the root node of the dendrogram stored by the
+        createOutputStep, without parsing the docfile again nor reading
+        any image. The stored arrays are loaded only once, but new
+        nodes are created in each call, so they can be selected freely.
+        For runs without the stored dendrogram, it is built again.
+        """
+        dendroFile = self._getDendrogramFile()
+        if not exists(dendroFile):
+            return self.buildDendrogram()
+
+        if getattr(self, '_dendrogram', None) is None:
+            self._dendrogram = readDendrogram(dendroFile)
+
+        # Also used for the representatives of the selected classes
+        self.dendroAverages = self._getFileName('averages')
+        return createDendroNodes(self._dendrogram, self.dendroAverages)
+
     def buildDendrogram(self, writeAverages=False):
         """ Parse Spider docfile with the information to build the dendrogram.
         Params:
@@ -207,129 +230,252 @@ class SpiderProtClassifyCluster(SpiderProtClassify):
         dendroFile = self._getFileName('dendroDoc')
         # Dendrofile is a docfile with at least 3 data columns (class, height, id)
         doc = SpiderDocFile(dendroFile)
-        values = []
-        indexes = []
-        for _, h, i in doc.iterValues():
-            indexes.append(i)
-            values.append(h)
+        data = doc.readArray()
         doc.close()
+        values = data[:, 1]
+        indexes = data[:, 2].tolist()
         
         self.dendroValues = values
         self.dendroIndexes = indexes
-        self.dendroImages = self._getFileName('particles')
         self.dendroAverages = self._getFileName('averages')
         self.dendroAverageCount = 0  # Write only the number of needed averages
+        self.dendroAverageImages = {}
         self.dendroMaxLevel = 10  # FIXME: remove hard coding if working the levels
-        self.ih = ImageHandler()
 
-        return self._buildDendrogram(0, len(values)-1, 1, writeAverages)
+        root = self._buildDendrogram(0, len(values)-1, 1)
+
+        if writeAverages:
+            # Images are only needed to compute the averages
+            self.dendroImages = SpiderStack(self._getFileName('particles'))
+            self._computeAverages(root)
+            self.dendroImages.close()
+            self._writeAverages()
+
+        return root
 
     def getImage(self, particleNumber):
-        return self.ih.read((int(particleNumber), self.dendroImages))
-        
-    def addChildNode(self, node, leftIndex, rightIndex, index,
-                     writeAverages, level, searchStop):
-        child = self._buildDendrogram(leftIndex, rightIndex, index,
-                                      writeAverages, level+1, searchStop)
-        node.addChild(child)
-        node.extendImageList(child.imageList)
+        return self.dendroImages.getImage(particleNumber)
+
+    def _writeAverages(self):
+        """ Write the class averages in the order of their avgCount. """
+        stack = SpiderStackWriter(self.dendroAverages)
+        images = self.dendroAverageImages
+        for avgCount in range(1, self.dendroAverageCount + 1):
+            stack.write(images.get(avgCount, numpy.zeros_like(images[1])))
+        stack.close()
+        self.dendroAverageImages = {}
+
+    def _sumLeafRanges(self, starts, chunkSize=1000):
+        """ Sum the particles of consecutive ranges of leaves, given the
+        (sorted) position of the first leaf of each range. The stack is
+        read only once and in order, a chunk of particles at a time,
+        adding each particle to the sum of its range.
+        """
+        stack = self.dendroImages
+        n = len(stack)
+        # Range of each particle in the stack (-1 if not in the dendrogram)
+        indexes = numpy.asarray(self.dendroIndexes, dtype=int) - 1
+        positions = numpy.full(n, -1)
+        positions[indexes] = numpy.arange(len(indexes))
+        ranges = numpy.searchsorted(starts, positions, side='right') - 1
+        ranges[positions < 0] = -1
+
+        sums = numpy.zeros((len(starts),) + stack[0].shape,
+                           dtype=numpy.float32)
+        for i in range(0, n, chunkSize):
+            chunkRanges = ranges[i:i+chunkSize]
+            order = numpy.argsort(chunkRanges, kind='stable')
+            order = order[chunkRanges[order] >= 0]
+            if not len(order):
+                continue
+            chunkRanges = chunkRanges[order]
+            # Segments of particles of the same range, after sorting
+            # (summing slices is much faster than numpy.add.reduceat
+            # along the first axis)
+            bounds = numpy.flatnonzero(numpy.r_[True, chunkRanges[1:] !=
+                                                chunkRanges[:-1]])
+            images = stack[i:i+chunkSize][order]
+            for start, end in zip(bounds, numpy.r_[bounds[1:], len(order)]):
+                sums[chunkRanges[start]] += images[start:end].sum(
+                    axis=0, dtype=numpy.float32)
+        return sums
+
+    def _computeAverages(self, root):
+        """ Compute the class averages of the nodes of the dendrogram,
+        from the sums of the leaves of the nodes without childs
+        (computed in a single pass over the stack) and then bottom-up,
+        storing them in self.dendroAverageImages.
+        """
+        nodes = []  # childs before parents
+
+        def addNodes(node):
+            for child in node.getChilds():
+                addNodes(child)
+            nodes.append(node)
+
+        addNodes(root)
+        lastNodes = sorted((n for n in nodes if not n.getChilds()),
+                           key=lambda n: n.first)
+        sums = self._sumLeafRanges([n.first for n in lastNodes])
+        images = {n.first: s for n, s in zip(lastNodes, sums)}
+
+        for node in nodes:
+            childs = node.getChilds()
+            if childs:
+                node.image = numpy.sum([c.image for c in childs], axis=0)
+            else:
+                node.image = images[node.first]
+            self._setAverage(node)
+
+        for node in nodes:
+            del node.image  # Allow to free the images memory
+
+    def _setAverage(self, node):
+        """ Normalize the sum of images of the node and store it. """
+        # normalize the sum of images depending on the number of particles
+        # assigned to this classes
+        node.image /= float(node.getSize())
+        collapsedAvgCount = getattr(node, 'collapsedAvgCount', None)
+        if collapsedAvgCount is not None:
+            # The node replaced its single-child parent, whose average
+            # was the (normalized again) average of the node
+            self.dendroAverageImages[collapsedAvgCount] = node.image.copy()
+            node.image /= float(node.getSize())
+        self.dendroAverageImages[node.avgCount] = node.image.copy()
+        fn = self._getTmpPath('doc_class%03d.stk' % node.index)
+        doc = SpiderDocFile(fn, 'w+')
+        doc.writeArray(node.imageList)
+        doc.close()
 
-        if writeAverages:
-            node.addImage(child.image)
-            del child.image  # Allow to free child image memory
-                
     def _buildDendrogram(self, leftIndex, rightIndex, index,
-                         writeAverages=False, level=0, searchStop=0):
+                         level=0, searchStop=0):
         """ This function is recursively called to create the dendrogram
-        graph (binary tree) and also to write the average image files.
+        graph (binary tree). The averages are computed later.
         Params:
             leftIndex, rightIndex: the indexes within the list where to search.
             index: the index of the class average.
-            writeAverages: flag to select when to write averages
             searchStop: this could be 1, means that we will search until the
                 last element (used for right childs of the dendrogram or,
                 can be 0, meaning that the last element was already the max
                 (used for left childs )
         From self:
-            self.dendroValues: the list with the heights of each node
-            self.dendroImages: image stack filename to read particles
+            self.dendroValues: the array with the heights of each node
             self.dendroAverages: stack name where to write averages
         It will search for the max in values list (between minIndex and maxIndex).
         Nodes to the left of the max are left childs and the other right childs.
+        Only the nodes above self.dendroMaxLevel (the ones with a class
+        average) are created, so the recursion depth is at most that level
+        and each level of the tree scans the heights only once. Deeper
+        nodes were only used to sum the images of their leaves.
         """
-        if level < self.dendroMaxLevel:
-            avgCount = self.dendroAverageCount + 1
-            self.dendroAverageCount += 1
-                    
-        if rightIndex == leftIndex:  # Just only one element
-            height = self.dendroValues[leftIndex]
-            node = DendroNode(index, height)
-            node.extendImageList([self.dendroIndexes[leftIndex]])
-            node.addImage(self.getImage(node.imageList[0]))
+        avgCount = self.dendroAverageCount + 1
+        self.dendroAverageCount += 1
+        values = self.dendroValues
+        hasChilds = False
 
+        if rightIndex == leftIndex:  # Just only one element
+            height = values[leftIndex]
         elif rightIndex == leftIndex + 1:  # Two elements
-            height = max(self.dendroValues[leftIndex], 
-                         self.dendroValues[rightIndex])
-            node = DendroNode(index, height)
-            node.extendImageList([self.dendroIndexes[leftIndex],
-                                  self.dendroIndexes[rightIndex]])
-            node.addImage(self.getImage(node.imageList[0]),
-                          self.getImage(node.imageList[1]))
+            height = max(values[leftIndex], values[rightIndex])
         else:  # 3 or more elements
-            # Find the max value (or height) of the elements
-            maxValue = self.dendroValues[leftIndex]
-            maxIndex = 0
+            # Find the (first) max value (or height) of the elements
             # searchStop could be 0 (do not consider last element, coming from
             # left child, or 1 (consider also the last one, coming from right)
-            values = self.dendroValues[leftIndex+1:rightIndex+searchStop]
-            for i, v in enumerate(values):
-                if v > maxValue:
-                    maxValue = v
-                    maxIndex = i+1
-            m = maxIndex + leftIndex
-            node = DendroNode(index, maxValue)
+            m = leftIndex + int(numpy.argmax(
+                values[leftIndex:rightIndex+searchStop]))
+            height = values[m]
+            hasChilds = height > 0 and level + 1 < self.dendroMaxLevel
+
+        node = DendroNode(index, float(height))
+        node.extendImageList(self.dendroIndexes[leftIndex:rightIndex+1])
+
+        if hasChilds:
             hasRightChild = m < rightIndex
+            nextIndex = 2 * index if hasRightChild else index
+            node.addChild(self._buildDendrogram(leftIndex, m, nextIndex,
+                                                level+1, 0))
 
-            if maxValue > 0:
-                nextIndex = 2 * index if hasRightChild else index
-                self.addChildNode(node, leftIndex, m, nextIndex,
-                                  writeAverages, level, 0)
-
-                if hasRightChild:
-                    self.addChildNode(node, m+1, rightIndex, 2 * index + 1,
-                                      writeAverages, level, 1)
-                else:
-                    # If the node has a single child, we will remove a node
-                    # just to advance in the level of the tree to get more
-                    # different class averages
-                    if node.getChilds():
-                        child = node.getChilds()[0]
-                        child.image = node.image
-                        child.parents = []
-                        node = child
+            if hasRightChild:
+                node.addChild(self._buildDendrogram(m+1, rightIndex,
+                                                    2 * index + 1,
+                                                    level+1, 1))
             else:
-                node.extendImageList(self.dendroIndexes[leftIndex:rightIndex+1])
-                node.addImage(*[self.getImage(img) for img in node.imageList])
-
-        if level < self.dendroMaxLevel:
-            node.avgCount = avgCount
-            node.path = '%d@%s' % (node.avgCount, self.dendroAverages)
-            
-            if writeAverages:
-                # normalize the sum of images depending on the number of particles
-                # assigned to this classes
-                # avgImage = node.image / float(node.getSize())
-                node.image.inplaceDivide(float(node.getSize()))
-                self.ih.write(node.image, (node.avgCount, self.dendroAverages))
-                fn = self._getTmpPath('doc_class%03d.stk' % index)
-                doc = SpiderDocFile(fn, 'w+')
-                for i in node.imageList:
-                    doc.writeValues(i)
-                doc.close()
-                
+                # If the node has a single child, we will remove a node
+                # just to advance in the level of the tree to get more
+                # different class averages
+                child = node.getChilds()[0]
+                child.parents = []
+                child.collapsedAvgCount = child.avgCount
+                node = child
+
+        # The images of any node are a contiguous range of the leaves
+        node.first = leftIndex
+        node.last = rightIndex
+        node.avgCount = avgCount
+        node.path = '%d@%s' % (node.avgCount, self.dendroAverages)
+
         return node
     
 
+# Arrays of the dendrogram stored by writeDendrogram, one value per node
+DENDRO_ARRAYS = ['index', 'parent', 'height', 'first', 'last', 'avgCount']
+
+
+def writeDendrogram(filename, root):
+    """ Store the nodes of the dendrogram (only the ones with a class
+    average) in a compact form: for each node, the row of its parent,
+    its height, the range of its leaves in the list of particles and
+    the index of its average in the averages stack.
+    """
+    rows = {key: [] for key in DENDRO_ARRAYS}
+
+    def addNode(node, parentRow):
+        row = len(rows['index'])
+        for key, value in zip(DENDRO_ARRAYS, [node.index, parentRow,
+                                              node.height, node.first,
+                                              node.last, node.avgCount]):
+            rows[key].append(value)
+        for child in node.getChilds():
+            addNode(child, row)
+
+    addNode(root, -1)
+    arrays = {key: numpy.array(values) for key, values in rows.items()}
+    # The images of the root are all the leaves, in order
+    arrays['images'] = numpy.array(root.imageList, dtype=int)
+    with open(filename, 'wb') as f:  # avoid the .npz extension added
+        numpy.savez(f, **arrays)
+
+
+def readDendrogram(filename):
+    """ Read the dictionary of arrays written by writeDendrogram. """
+    with numpy.load(filename) as data:
+        return {key: data[key] for key in DENDRO_ARRAYS + ['images']}
+
+
+def createDendroNodes(dendrogram, averages):
+    """ Create the DendroNode tree from the arrays read with
+    readDendrogram and return its root.
+    Params:
+        averages: the stack with the class averages of the nodes.
+    """
+    images = dendrogram['images']
+    nodes = []
+    for row in range(len(dendrogram['index'])):
+        node = DendroNode(int(dendrogram['index'][row]),
+                          float(dendrogram['height'][row]))
+        node.first = int(dendrogram['first'][row])
+        node.last = int(dendrogram['last'][row])
+        node.extendImageList(images[node.first:node.last+1].tolist())
+        node.avgCount = int(dendrogram['avgCount'][row])
+        node.path = '%d@%s' % (node.avgCount, averages)
+        parentRow = dendrogram['parent'][row]
+        if parentRow >= 0:
+            nodes[parentRow].addChild(node)
+        nodes.append(node)
+
+    return nodes[0]
+
+
 class DendroNode(graph.Node):
     """ Special type of Node to store dendrogram values. """
     def __init__(self, index, height):
@@ -353,9 +499,9 @@ class DendroNode(graph.Node):
         """ Add some images to this node. """
         for img in images:
             if self.image is None:
-                self.image = img
+                self.image = numpy.array(img, dtype=numpy.float32)
             else:
-                self.image.inplaceAdd(img)
+                self.image += img
 
     def extendImageList(self, imageList):
         self.imageList.extend(imageList)
@@ -27,9 +27,13 @@
 from enum import Enum
 
 from pyworkflow.constants import PROD
-from pyworkflow.protocol.params import IntParam
+from pyworkflow.protocol.params import IntParam, EnumParam
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from pwem.objects import SetOfClasses2D
 
+from ..constants import ENGINE_SPIDER, ENGINE_NUMPY
+from ..averages import (readClassAssignment, computeClassAverages,
+                        writeClassAverages, writeClassSizes)
 from ..utils import SpiderDocFile
 from .protocol_classify_base import SpiderProtClassify
 
@@ -59,6 +63,16 @@ class SpiderProtClassifyKmeans(SpiderProtClassify):
         form.addParam('numberOfClasses', IntParam, default=4, 
                       label='Number of classes',
                       help='Desired number of classes.')
+        form.addParam('engine', EnumParam, choices=['Spider', 'NumPy'],
+                      default=ENGINE_SPIDER, expertLevel=LEVEL_ADVANCED,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Class averages engine',
+                      help='With *Spider* the average and variance of each '
+                           'class are computed one class after the other '
+                           'with AS R in SPIDER.\n'
+                           'With *NumPy* they are computed by Scipion for '
+                           'all classes in a single pass over the particles, '
+                           'split between the threads.')
         
     def getNumberOfClasses(self):
         return self.numberOfClasses.get()
@@ -66,9 +80,34 @@ class SpiderProtClassifyKmeans(SpiderProtClassify):
     # --------------------------- STEPS functions -----------------------------
     def _updateParams(self):
         self._params.update({'x20': self.getNumberOfClasses(),
+                             'x31': int(self.engine == ENGINE_SPIDER),
                              '[particles]': self._params['particles'] + '@******',
                              })
 
+    def classifyStep(self, imcFile, numberOfFactors, numberOfClasses):
+        SpiderProtClassify.classifyStep(self, imcFile, numberOfFactors,
+                                        numberOfClasses)
+        if self.engine == ENGINE_NUMPY:
+            self._computeClassAverages(numberOfClasses)
+
+    def _computeClassAverages(self, numberOfClasses):
+        """ Write the same class averages, variances and class sizes
+        as the kmeans.msa script, from the class assignment doc.
+        """
+        particlesFn = self._getFileName('particles')
+        classes = readClassAssignment(
+            self._getPath(self.getClassDir(), 'docassign.stk'),
+            self.inputParticles.get().getSize())
+        averages, variances, counts = computeClassAverages(
+            particlesFn, classes, numberOfClasses,
+            numberOfWorkers=self.numberOfThreads.get())
+
+        classPath = lambda fn: self._getPath(self.getClassDir(), fn)
+        writeClassAverages(averages, variances,
+                           classPath('classavg%03d.stk'),
+                           classPath('classvar%03d.stk'))
+        writeClassSizes(classPath('listclasses.stk'), counts)
+
     def createOutputStep(self):
         """ Create the SetOfClass from the docfile with the images-class
         assignment, the averages for each class.
@@ -82,7 +121,8 @@ class SpiderProtClassifyKmeans(SpiderProtClassify):
         # is the same for the input particles and the generated Spider stack
         classes2D.classifyItems(updateItemCallback=self._updateParticle,
                                 updateClassCallback=self._updateClass,
-                                itemDataIterator=clsdoc.iterValues())
+                                itemDataIterator=iter(clsdoc.readArray().tolist()))
+        clsdoc.close()
 
         self._defineOutputs(**{outputs.outputClasses.name: classes2D})
         self._defineSourceRelation(particles, classes2D)
@@ -27,12 +27,15 @@
 from enum import Enum
 
 from pyworkflow.constants import PROD
-from pyworkflow.protocol.params import PointerParam, FloatParam
+from pyworkflow.protocol.params import PointerParam, FloatParam, EnumParam
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
 from pwem.protocols import ProtCreateMask2D
 from pwem.objects import Mask
 from pwem.emlib.image import ImageHandler
 
-from ..utils import runCustomMaskScript
+from ..constants import ENGINE_SPIDER, ENGINE_NUMPY
+from ..filters import CustomMask
+from ..utils import runCustomMaskScript, SpiderStack, SpiderStackWriter
 from .protocol_base import SpiderProtocol
 
 
@@ -93,6 +96,14 @@ class SpiderProtCustomMask(ProtCreateMask2D, SpiderProtocol):
                       label='Mask threshold (range: approx. 0 - 1)',
                       help='The filtered intermediate mask will be thresholded '
                            'to generate the final mask.')
+        form.addParam('engine', EnumParam, choices=['Spider', 'NumPy'],
+                      default=ENGINE_SPIDER, expertLevel=LEVEL_ADVANCED,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Masking engine',
+                      help='With *Spider* the mask is created by running '
+                           'the custommask.msa script in SPIDER.\n'
+                           'With *NumPy* the same steps are computed in '
+                           'memory by Scipion, without running SPIDER.')
         
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
@@ -119,12 +130,31 @@ class SpiderProtCustomMask(ProtCreateMask2D, SpiderProtocol):
         """ Apply the selected filter to particles. 
         Create the set of particles.
         """
+        if self.engine == ENGINE_NUMPY:
+            self._createMaskNumpy(filterRadius1, sdFactor,
+                                  filterRadius2, maskThreshold)
+            return
+
         runCustomMaskScript(filterRadius1, sdFactor,
                             filterRadius2, maskThreshold,
                             workingDir=self._getPath(), ext=self.getExt(),
                             inputImage=self._params['inputImage']+'@1',
-                            outputMask=self._params['outputMask'])
+                            outputMask=self._params['outputMask'],
+                            cache=self.getOutputsCache())
                             
+    def _createMaskNumpy(self, filterRadius1, sdFactor,
+                         filterRadius2, maskThreshold):
+        """ Write the same output stack as the Spider script. """
+        inputStack = SpiderStack(self._getFileName('inputImage'))
+        customMask = CustomMask(inputStack.getImage(1))
+        inputStack.close()
+
+        outputStack = SpiderStackWriter(self._getFileName('outputMask'))
+        for img in customMask.compute(filterRadius1, sdFactor,
+                                      filterRadius2, maskThreshold):
+            outputStack.write(img)
+        outputStack.close()
+
     def createOutputStep(self):
         maskFn = self._getFileName('outputMask')
         mask = Mask()
@@ -31,12 +31,16 @@ from pwem.protocols import ProtFilterParticles
 from pwem.objects import SetOfParticles
 from pyworkflow.protocol.params import (EnumParam, BooleanParam,
                                         DigFreqParam, FloatParam)
-from pyworkflow.utils.path import removeBaseExt
+from pyworkflow.protocol.constants import LEVEL_ADVANCED
+from pyworkflow.utils.path import removeBaseExt, moveFile
 from pyworkflow.constants import PROD
 
 from ..constants import (FILTER_BUTTERWORTH, FILTER_FERMI,
-                         FILTER_LOWPASS, FILTER_SPACE_REAL)
-from ..utils import SpiderShell
+                         FILTER_LOWPASS, FILTER_SPACE_REAL,
+                         ENGINE_SPIDER, ENGINE_NUMPY)
+from ..filters import filterImages
+from ..utils import (SpiderShell, SpiderStack, SpiderStackWriter,
+                     splitRange)
 from .protocol_base import SpiderProtocol
 
 
@@ -121,7 +125,15 @@ See detailed description of the filter at [[https://spider.wadsworth.org/spider_
                       label='Temperature T:',
                       condition='filterType == %d' % FILTER_FERMI,
                       help='Enter a temperature parameter T The filter falls off roughly within \n'
-                           'this reciprocal distance (in terms of frequency units).')     
+                           'this reciprocal distance (in terms of frequency units).')
+        form.addParam('engine', EnumParam, choices=['Spider', 'NumPy'],
+                      default=ENGINE_SPIDER, expertLevel=LEVEL_ADVANCED,
+                      display=EnumParam.DISPLAY_HLIST,
+                      label='Filtering engine',
+                      help='With *Spider* the particles are filtered by '
+                           'running FQ in SPIDER.\n'
+                           'With *NumPy* the same filters are computed in '
+                           'memory by Scipion, without running SPIDER.')
         
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
@@ -131,7 +143,10 @@ See detailed description of the filter at [[https://spider.wadsworth.org/spider_
         self._insertFunctionStep('convertInput', 'inputParticles', 
                                  self._getFileName('particles'),
                                  self._getFileName('particlesSel'))
-        self._insertFunctionStep('filterStep', self.filterType.get())
+        if self.engine == ENGINE_NUMPY:
+            self._insertFunctionStep('filterNumpyStep', self.filterType.get())
+        else:
+            self._insertFunctionStep('filterStep', self.filterType.get())
         self._insertFunctionStep('createOutputStep')
 
     # --------------------------- STEPS functions -----------------------------
@@ -160,22 +175,63 @@ See detailed description of the filter at [[https://spider.wadsworth.org/spider_
         # Consider low-pass or high-pass
         filterNumber += self.filterMode.get()
 
-        self._enterWorkingDir()  # Do operations inside the run working dir
-        
-        spi = SpiderShell(ext=self.getExt())  # Create the Spider process to send commands
         particlesStk = removeBaseExt(self.particlesStk)
-        
-        # Run a loop for filtering
         locStr = particlesStk + '@******[part]'
-        cmds = ['do lb5 [part] = 1,%d' % n,
-                OP, locStr, locStr, filterNumber] + args + ['lb5']
-        
-        for c in cmds:
-            spi.runCmd(c)
-            
-        spi.close()
-            
-        self._leaveWorkingDir()  # Go back to project dir
+        # Split the particles in contiguous ranges, each one filtered in
+        # place by a different Spider process (MPI is not allowed here)
+        numberOfShards = self.numberOfThreads.get()
+        shells = []
+
+        self._enterWorkingDir()  # Do operations inside the run working dir
+        try:
+            for first, last in splitRange(n, numberOfShards):
+                spi = SpiderShell(ext=self.getExt(), duplex=True)
+                shells.append(spi)
+                # Run a loop for filtering, using a single thread per process
+                cmds = ['MD', 'SET MP', 1,
+                        'do lb5 [part] = %d,%d' % (first, last),
+                        OP, locStr, locStr, filterNumber] + args + ['lb5']
+                for c in cmds:
+                    spi.runCmd(c)
+
+            # Wait for all loops to finish, raising an error as soon as
+            # Spider reports it
+            for spi in shells:
+                spi.sync()
+        except Exception:
+            for spi in shells:
+                spi.kill()
+            raise
+        finally:
+            self._leaveWorkingDir()  # Go back to project dir
+
+        for spi in shells:
+            spi.close()
+
+    def filterNumpyStep(self, filterType, chunkSize=1000):
+        """ Apply the selected filter to particles in memory,
+        producing the same output as filterStep.
+        """
+        stack = SpiderStack(self.particlesStk)
+        filteredStk = self._getTmpPath(removeBaseExt(self.particlesStk) +
+                                       '.' + self.getExt())
+        filtered = SpiderStackWriter(filteredStk)
+
+        for i in range(0, len(stack), chunkSize):
+            images = filterImages(stack[i:i+chunkSize], filterType,
+                                  filterMode=self.filterMode.get(),
+                                  usePadding=self.usePadding.get(),
+                                  filterRadius=self.filterRadius.get(),
+                                  lowFreq=self.lowFreq.get(),
+                                  highFreq=self.highFreq.get(),
+                                  temperature=self.temperature.get(),
+                                  workers=self.numberOfThreads.get())
+            for img in images:
+                filtered.write(img)
+
+        filtered.close()
+        stack.close()
+        moveFile(filteredStk, self.particlesStk)
 
     def createOutputStep(self):
         particles = self.inputParticles.get()
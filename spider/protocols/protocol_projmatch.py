@@ -26,10 +26,13 @@
 # *
 # **************************************************************************
 
-from os.path import join
+from os.path import join, exists
 from glob import glob
 import re
 from enum import Enum
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy
 
 import pyworkflow.utils as pwutils
 from pyworkflow.constants import PROD
@@ -37,14 +40,19 @@ import pyworkflow.protocol.params as params
 from pwem.protocols import ProtRefine3D
 from pwem.emlib.image import ImageHandler
 from pwem.constants import ALIGN_PROJ
-from pwem.objects import Volume, FSC, SetOfParticles
+from pwem.objects import Volume, FSC, SetOfParticles, Transform
 
 from .. import Plugin
-from ..utils import (SpiderDocFile, SpiderDocAliFile,
-                     writeScript, runScript)
-from ..convert import convertEndian, alignmentToRow
-from ..constants import (GOLD_STD, BP_3F, DEF_GROUPS, ANGLE_PHI, ANGLE_THE,
-                         ANGLE_PSI, SHIFTX, SHIFTY)
+from ..utils import (SpiderDocFile, SpiderStackWriter, SpiderShell,
+                     HEADER_COLUMNS, writeScript, runScript)
+from ..convert import rowsToAlignments, writeAlignmentDoc
+from ..angles import (getEvenAngles, AngularIndex,
+                      writeAnglesDoc, readAnglesDoc)
+from ..cache import FileCache, hashFiles
+from ..partition import (getNumberOfGroups, balanceGroups,
+                         writeGroupManifest, readGroupManifest)
+from ..constants import (GOLD_STD, BP_3F, DEF_GROUPS,
+                         ITER_ALL, ITER_PREPARE, ITER_MERGE)
 from .protocol_base import SpiderProtocol
 
 
@@ -75,6 +83,19 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
     def _defineParams(self, form):
         form.addSection(label='Input')
 
+        form.addParam('doContinue', params.BooleanParam, default=False,
+                      label='Continue from a previous run?',
+                      help='If set to *Yes*, the refinement will continue '
+                           'from the last finished iteration of the '
+                           'selected run, which should use the same inputs. '
+                           'Set a higher number of iterations to refine '
+                           'further.')
+        form.addParam('continueRun', params.PointerParam,
+                      pointerClass=self.getClassName(),
+                      condition='doContinue', allowsNull=True,
+                      label='Select previous run',
+                      help='Select a previous refinement run to continue from.')
+
         form.addParam('protType', params.EnumParam,
                       choices=['with defocus groups', 'gold-standard'],
                       default=GOLD_STD,
@@ -139,6 +160,13 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
                       help="Choose backprojection method (BP CG, BP 3F, BP RP or BP 3N). "
                            "More information on Spider "
                            "[[https://spider.wadsworth.org/spider_doc/spider/docs/bp_overview.html][web-site]]")
+        form.addParam('groupsPerWorker', params.IntParam, default=1,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      condition='protType == 1',
+                      label='Groups per MPI process',
+                      help="The particles are split in groups of the same "
+                           "size, this number of groups for each MPI "
+                           "process (with a minimum of 2 groups).")
         
         form.addParam('smallAngle', params.BooleanParam, default=False,
                       label='Use small angle refinement?',
@@ -173,6 +201,18 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
                            "For example, in the default *2x0 15 8 6 5*, "
                            "the increment will be: iter 1,2 - unrestricted, iter 3 - 15 degrees, iter 4 - 8 degrees, "
                            "iter 5 - 6 degrees and iterations from the sixth onward will use 5 degrees.")
+        form.addParam('projCacheSize', params.FloatParam, default=20,
+                      expertLevel=params.LEVEL_ADVANCED,
+                      condition='protType == 1 and not smallAngle',
+                      label='Projections cache size (GB)',
+                      help="Reference projections are kept in the project "
+                           "Tmp folder, and reused by any refinement that "
+                           "projects the same volumes with the same angular "
+                           "increment, range and projection diameter (e.g. "
+                           "when running again with a different shift range). "
+                           "The least recently used projections are removed "
+                           "when the cache gets bigger than this size. "
+                           "Use 0 to disable the cache.")
         form.addParam('angStepSm', params.FloatParam, default=0.5,
                       condition='smallAngle',
                       label='Angular increment',
@@ -190,7 +230,10 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
         self._insertFunctionStep('convertInputStep',
                                  self.inputParticles.get().getObjId())
 
-        self._insertFunctionStep('runScriptStep', 'refine.pam')
+        # Run each iteration in a separate step, so Scipion
+        # can report the progress and resume a failed run
+        for it in range(1, self.numberOfIterations.get() + 1):
+            self._insertFunctionStep('runIterationStep', it)
                 
         self._insertFunctionStep('createOutputStep')
     
@@ -201,15 +244,34 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
         partSet = self.inputParticles.get()
         protType = self.protType.get()
 
-        self._writeParamsFile(partSet)
-        self._writeGroupFiles(partSet, protType)
-        
-        # Convert the input volume
-        volPath = self._getExtraPath('ref_vol.vol')
-        ImageHandler().convert(self.input3DReference.get(), volPath)
-        pwutils.moveFile(volPath, volPath.replace('.vol', '.stk'))
+        if self.doContinue:
+            # Start from the files (and finished iterations) of the
+            # previous run, only the scripts are written again
+            pwutils.copyTree(self.continueRun.get()._getExtraPath(),
+                             self._getExtraPath())
+        else:
+            self._writeParamsFile(partSet)
+            self._writeGroupFiles(partSet, protType)
+
+            # Convert the input volume
+            volPath = self._getExtraPath('ref_vol.vol')
+            ImageHandler().convert(self.input3DReference.get(), volPath)
+            pwutils.moveFile(volPath, volPath.replace('.vol', '.stk'))
         
         self._writeRefinementScripts(protType)
+        self._writeAngleSamplings()
+
+    def _writeAngleSamplings(self):
+        """ Compute the reference angles once for each angular step,
+        they are used in all iterations with the same step.
+        """
+        if self.protType != GOLD_STD or self.smallAngle:
+            return
+
+        pwutils.makePath(self._getExtraPath('angles'))
+        for angStep in set(self._getIterValues(self.angSteps.get())):
+            writeAnglesDoc(self._getAnglesFile(angStep),
+                           getEvenAngles(angStep))
                 
     def _writeRefinementScripts(self, protType):
         """ Write the needed scripts to run refinement
@@ -222,20 +284,20 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
             """ Escape path with '' and add ../ """
             return "'%s'" % join('..', p)
         
-        def script(name, paramsDict={}, protType=protType):
+        def script(name, paramsDict={}, protType=protType, outputName=None):
             if protType == DEF_GROUPS:
                 dirName = 'defocus-groups'
             else:
                 dirName = 'no-defocus-groups'
 
-            outputScript = join(refPath, name)
+            outputScript = join(refPath, outputName or name)
             writeScript(Plugin.getScript('projmatch', 'Refinement', dirName, name),
                         outputScript, paramsDict)
             
         nIter = self.numberOfIterations.get()
         
         def getListStr(valueStr):
-            return "'%s'" % ','.join(pwutils.getListFromValues(valueStr, nIter))
+            return "'%s'" % ','.join(str(v) for v in self._getIterValues(valueStr))
 
         diam = int(self.radius.get() * 2 * self.inputParticles.get().getSamplingRate())
         params = {'[alignsh]': self.alignmentShift.get(),
@@ -266,7 +328,8 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
         script('refine_settings.pam', params)
         if protType == DEF_GROUPS:
             scriptList = ['refine', 'prepare', 'grploop', 'mergegroups',
-                          'enhance', 'endmerge', 'smangloop', 'endrefine']
+                          'enhance', 'endmerge', 'smangloop', 'endrefine',
+                          'grpjob']
         else:
             scriptList = ['refine', 'refine-setrefangles',
                           'refine-prjrefs', 'refine-loop', 'refine-smangloop',
@@ -275,6 +338,18 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
 
         for s in scriptList:
             script('%s.pam' % s)
+
+        # One main script per iteration, and with defocus groups
+        # also the ones to prepare and merge the parallel groups
+        phases = [ITER_ALL]
+        if protType == DEF_GROUPS:
+            phases += [ITER_PREPARE, ITER_MERGE]
+
+        for it in range(1, nIter + 1):
+            for phase in phases:
+                script('refine.pam', {'[iter-first]': it, '[iter-last]': it,
+                                      '[iter-phase]': phase},
+                       outputName=self._getIterScript(it, phase))
         
     def _writeParamsFile(self, partSet):
         acq = partSet.getAcquisition()
@@ -303,8 +378,8 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
         - selfile
         - docfile
         """
-        ih = ImageHandler()
-        # Keep a dict with all groups found in particles
+        # Keep a dict with all groups found in particles,
+        # the files are only written once all groups are known
         groupDict = {}
         template = self._getExtraPath('group%03d_%s.stk')
 
@@ -313,55 +388,178 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
                 defocusGroup = self._getDefocusGroup(part)
 
                 if defocusGroup not in groupDict:
-                    groupInfo = DefocusGroupInfo(defocusGroup, template, ih)
+                    groupInfo = DefocusGroupInfo(defocusGroup, template)
                     groupDict[defocusGroup] = groupInfo
                 else:
                     groupInfo = groupDict[defocusGroup]
 
                 groupInfo.addParticle(part)
         else:
-            numProcs = self.numberOfMpi.get()
-            # explicitly set a minimum of 2 groups
-            # GS: maybe not necessary?
-            numGroups = 2 if numProcs < 3 else numProcs
-            d, r = divmod(len(partSet), numGroups)
-            numParts = d + 1 if r > 0 else d
+            # Contiguous groups of the same size (+-1 particle),
+            # the same number of groups for each MPI process
+            numGroups = getNumberOfGroups(self.numberOfMpi.get(),
+                                          self.groupsPerWorker.get())
+            ranges = balanceGroups(len(partSet), numGroups)
+            for groupId, (first, last) in enumerate(ranges, 1):
+                groupDict[groupId] = DefocusGroupInfo(groupId, template,
+                                                      first, last)
             groupId = 1
 
-            for part in partSet:
-                if groupId not in groupDict:
-                    groupInfo = DefocusGroupInfo(groupId, template, ih)
-                    groupDict[groupId] = groupInfo
-                else:
-                    groupInfo = groupDict[groupId]
-                    groupSize = groupDict[groupId].counter
-                    if groupSize > numParts:
-                        groupId += 1
-                        groupInfo = DefocusGroupInfo(groupId, template, ih)
-                        groupDict[groupId] = groupInfo
+            for i, part in enumerate(partSet, 1):
+                if i > groupDict[groupId].last:
+                    groupId += 1
+                groupDict[groupId].addParticle(part)
 
-                groupInfo.addParticle(part)
-
-        # Write the docfile with the group information
+        # Write the manifest with the group information
         # like the number of particles (and the defocus)
-        groupsDoc = SpiderDocFile(self._getExtraPath('sel_group.stk'), 'w+')
-        for gi in groupDict.values():
-            if protType == DEF_GROUPS:
-                groupsDoc.writeValues(gi.number, gi.counter, gi.defocus)
-            else:
-                groupsDoc.writeValues(gi.number, gi.counter)
-            # Convert the endianness of the stack
-            convertEndian(gi.stackfile, gi.counter)
-            # Close each group docfile
-            gi.close()
+        writeGroupManifest(self._getExtraPath('sel_group.stk'),
+                           [gi.getManifestRow() for gi in groupDict.values()])
 
-        groupsDoc.close()
+        # Write the stack, selfile and docfile of the groups in parallel
+        with ProcessPoolExecutor(self.numberOfThreads.get()) as executor:
+            for _ in executor.map(writeGroupFiles, groupDict.values()):
+                pass
         
     def runScriptStep(self, script):
         """ Just run the script that was generated in convertInputStep. """
         refPath = self._getExtraPath('Refinement')
-        runScript(script, 'pam/stk', program=Plugin.getProgram(),
-                  nummpis=1, cwd=refPath, log=self._log)
+        with self.monitorProgress(script):
+            runScript(script, 'pam/stk', program=Plugin.getProgram(),
+                      nummpis=1, cwd=refPath, log=self._log)
+
+    def runIterationStep(self, iteration):
+        """ Run a single refinement iteration, unless it was already
+        finished (e.g. in the run we are continuing from).
+        """
+        if self._isIterationDone(iteration):
+            self.info("Iteration %d was already finished." % iteration)
+        elif self.protType == DEF_GROUPS and self._getGroupWorkers() > 1:
+            self._runGroupsIteration(iteration)
+        else:
+            self._writeRefAngles(iteration)
+            cacheKey = self._restoreProjections(iteration)
+            self.runScriptStep(self._getIterScript(iteration))
+            self._storeProjections(iteration, cacheKey)
+
+    def _runGroupsIteration(self, iteration):
+        """ Run an iteration aligning the defocus groups in parallel
+        Spider processes, while refine.pam prepares the iteration
+        before and merges the groups after.
+        """
+        refPath = self._getExtraPath('Refinement')
+        finalPath = join(refPath, 'final')
+        self.runScriptStep(self._getIterScript(iteration, ITER_PREPARE))
+
+        groups = [g['group'] for g in self._getGroupManifest()]
+
+        def alignGroup(group):
+            spi = SpiderShell(ext='pam/stk', cwd=refPath, duplex=True)
+            try:
+                lines = spi.runBatch(['[iter] = %d' % iteration,
+                                      '[grp] = %d' % group,
+                                      '@grpjob([iter],[grp])'])
+            except Exception:
+                spi.kill()
+                raise
+            spi.close()
+            self.info("Iteration %d, group %d:\n%s"
+                      % (iteration, group, '\n'.join(lines)))
+
+        with ThreadPoolExecutor(self._getGroupWorkers()) as executor:
+            for _ in executor.map(alignGroup, groups):
+                pass
+
+        # Append the resolution of each group, in the same
+        # order as they are written when running the groups serially
+        with open(join(finalPath, 'group_resolutions.stk'), 'a') as f:
+            for group in groups:
+                groupFn = join(finalPath, 'group_resolutions_%03d.stk' % group)
+                with open(groupFn) as groupFile:
+                    f.writelines(line for line in groupFile
+                                 if not line.lstrip().startswith(';'))
+                pwutils.cleanPath(groupFn)
+
+        self.runScriptStep(self._getIterScript(iteration, ITER_MERGE))
+
+    def _writeRefAngles(self, iteration):
+        """ Write the reference angles of this iteration, used by
+        refine-setrefangles.pam instead of running VO EA. With a
+        restricted search, only the references that are within the
+        angular range of some particle are projected and compared.
+        """
+        if self.protType != GOLD_STD or self.smallAngle:
+            return
+
+        angStep = self._getIterValues(self.angSteps.get())[iteration - 1]
+        angLimit = self._getIterValues(self.angLimits.get())[iteration - 1]
+        angles = readAnglesDoc(self._getAnglesFile(angStep))
+        # Alignment from the previous iteration, used to restrict the search
+        alignFiles = glob(self._getExtraPath('Refinement', 'final',
+                                             'align_%02d_???_s?.stk'
+                                             % iteration))
+
+        if angLimit > 0 and alignFiles:
+            directions = []
+            for fn in alignFiles:
+                alignDoc = SpiderDocFile(fn)
+                directions.append(alignDoc.readArray()[:, 1:3])  # theta, phi
+                alignDoc.close()
+            directions = numpy.vstack(directions)
+            reachable = AngularIndex(angles).getReachable(
+                directions[:, 0], directions[:, 1], angLimit)
+            if len(reachable):
+                self.info("Iteration %d, using %d of %d reference angles "
+                          "within %s degrees of the particles."
+                          % (iteration, len(reachable), len(angles), angLimit))
+                angles = angles[reachable]
+
+        workPath = self._getExtraPath('Refinement', 'work')
+        pwutils.makePath(workPath)
+        writeAnglesDoc(join(workPath, 'ref_angs_%02d.stk' % iteration), angles)
+
+    def _restoreProjections(self, iteration):
+        """ Copy the reference projections of this iteration from the
+        cache, if found, so refine-prjrefs.pam does not compute them.
+        Return the cache key or None if the cache is not used.
+        """
+        if self.protType != GOLD_STD or self.smallAngle:
+            return None
+
+        # Remove projections left by a failed attempt of this iteration,
+        # they are never reused, even without the cache
+        projections = self._getProjectionFiles(iteration)
+        cachedFlag = self._getCachedFlagFile(iteration)
+        pwutils.cleanPath(cachedFlag, *projections)
+
+        cache = self._getProjectionsCache()
+        if cache.maxSize <= 0:
+            return None
+
+        # The initial volume is copied to both subsets in the first iteration
+        if iteration == 1:
+            volumes = [self._getExtraPath('ref_vol.stk')] * 2
+        else:
+            volumes = [self._getExtraPath('Refinement', 'final',
+                                          'vol_%02d_s%d.stk' % (iteration, s))
+                       for s in [1, 2]]
+        # The reference angles depend on the step and angular range
+        refAngles = self._getExtraPath('Refinement', 'work',
+                                       'ref_angs_%02d.stk' % iteration)
+        cacheKey = hashFiles(refAngles, *volumes, winFrac=self.winFrac.get())
+
+        if cache.get(cacheKey, projections):
+            self.info("Iteration %d, reference projections restored "
+                      "from cache %s" % (iteration, cacheKey))
+            # Tell refine-prjrefs.pam to skip the projection
+            flagDoc = SpiderDocFile(cachedFlag, 'w+')
+            flagDoc.writeValues(1)
+            flagDoc.close()
+        return cacheKey
+
+    def _storeProjections(self, iteration, cacheKey):
+        if cacheKey is not None:
+            self._getProjectionsCache().put(
+                cacheKey, self._getProjectionFiles(iteration))
 
     def createOutputStep(self):
         imgSet = self.inputParticles.get()
@@ -397,6 +595,13 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
     # --------------------------- INFO functions ------------------------------
     def _validate(self):
         errors = []
+        if self.doContinue:
+            continueRun = self.continueRun.get()
+            if continueRun is None:
+                errors.append('Select the previous run to continue from.')
+            elif continueRun.protType.get() != self.protType.get():
+                errors.append('The previous run should use the same '
+                              'refinement type.')
         if self.smallAngle and not self.inputParticles.get().hasAlignmentProj():
             errors.append('*Small angle* option can only be used if '
                           'the particles have angular assignment.')
@@ -449,6 +654,58 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
     def _getDefocusGroup(self, img):
         return img.getMicId()
 
+    def _getGroupManifest(self):
+        """ Return the groups of particles used in the refinement. """
+        manifest = self._getExtraPath('Refinement', 'input', 'sel_group.stk')
+        if not exists(manifest):  # not moved yet by the scripts
+            manifest = self._getExtraPath('sel_group.stk')
+        return readGroupManifest(manifest)
+
+    def _getIterValues(self, valueStr):
+        """ Values for each iteration from a list like '3.3 3 3x2 1.5'. """
+        return pwutils.getFloatListFromValues(valueStr,
+                                              self.numberOfIterations.get())
+
+    def _getAnglesFile(self, angStep):
+        return self._getExtraPath('angles', 'ref_angs_%0.2f.stk' % angStep)
+
+    def _getProjectionsCache(self):
+        """ Cache shared by all refinements in the project Tmp folder. """
+        return FileCache(self._getProjectTmpPath('spider_projections'),
+                         maxSize=self.projCacheSize.get() * 1024 ** 3)
+
+    def _getProjectionFiles(self, iteration):
+        return [self._getExtraPath('Refinement', 'work',
+                                   'ref_projs_%02d_s%d.stk' % (iteration, s))
+                for s in [1, 2]]
+
+    def _getCachedFlagFile(self, iteration):
+        return self._getExtraPath('Refinement', 'work',
+                                  'ref_projs_%02d_cached.stk' % iteration)
+
+    def _getIterScript(self, iteration, phase=ITER_ALL):
+        if phase == ITER_ALL:
+            return 'refine_%02d.pam' % iteration
+        return 'refine_%02d_%d.pam' % (iteration, phase)
+
+    def _getGroupWorkers(self):
+        """ Number of defocus groups aligned at the same time. """
+        return self.numberOfThreads.get() * self.numberOfMpi.get()
+
+    def _isIterationDone(self, iteration):
+        """ Check if the iteration outputs are in Refinement/final. """
+        if self.protType == DEF_GROUPS:
+            template = 'Refinement/final/vol%02d.stk'
+        else:
+            template = 'Refinement/final/vol_%02d.stk'
+        done = exists(self._getExtraPath(template % (iteration + 1)))
+
+        if iteration == self.numberOfIterations.get():
+            # Final outputs are also created after the last iteration
+            done = done and exists(self._getExtraPath('stack_alignment.stk'))
+
+        return done
+
     def _getLastIterNumber(self):
         """ Return the list of iteration files, give the iterTemplate. """
         result = None
@@ -465,18 +722,25 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
         return result
 
     def _fillDataFromDoc(self, imgSet):
-        outDocFn = SpiderDocAliFile(self._getExtraPath('stack_alignment.stk'))
+        outDoc = SpiderDocFile(self._getExtraPath('stack_alignment.stk'))
+        data = outDoc.readArray()
+        outDoc.close()
+        # Convert all rows at once to transformation matrices
+        rows = {key: data[:, i] for i, key in enumerate(HEADER_COLUMNS)
+                if i < data.shape[1]}
+        matrices = rowsToAlignments(rows, ALIGN_PROJ)
+
         imgSet.setAlignmentProj()
         initPartSet = self.inputParticles.get()
         partIter = iter(initPartSet.iterItems(orderBy=['id'], direction='ASC'))
         imgSet.copyItems(partIter,
                          updateItemCallback=self._createItemMatrix,
-                         itemDataIterator=iter(outDocFn))
+                         itemDataIterator=iter(matrices))
 
-    def _createItemMatrix(self, item, row):
-        from ..convert import createItemMatrix
-        from pwem.constants import ALIGN_PROJ
-        createItemMatrix(item, row, align=ALIGN_PROJ)
+    def _createItemMatrix(self, item, matrix):
+        alignment = Transform()
+        alignment.setMatrix(matrix)
+        item.setTransform(alignment)
 
     def _getFscData(self, it):
         if self.protType == GOLD_STD:  # gold std
@@ -484,12 +748,11 @@ class SpiderProtRefinement(ProtRefine3D, SpiderProtocol):
         else:  # def groups
             fn = self._getExtraPath("Refinement/final/ofscdoc_%02d.stk" % it)
 
-        resolution = []
-        fscData = []
         fscDoc = SpiderDocFile(fn)
-        for values in fscDoc:
-            resolution.append(1 / values[1])
-            fscData.append(values[2])
+        data = fscDoc.readArray()
+        fscDoc.close()
+        resolution = (1 / data[:, 1]).tolist()
+        fscData = data[:, 2].tolist()
 
         return resolution, fscData
 
@@ -499,44 +762,49 @@ class DefocusGroupInfo:
     defocus groups like the number of particles
     or the docfile to be generated.
     """
-    def __init__(self, defocusGroup, template, ih):
-        self.ih = ih
+    def __init__(self, defocusGroup, template, first=0, last=0):
         self.number = defocusGroup
         self.selfile = template % (defocusGroup, 'selfile')
         self.docfile = template % (defocusGroup, 'align')
         self.stackfile = template % (defocusGroup, 'stack')
         self.counter = 0  # number of particles in this group
+        self.defocus = 0
+        # range of particles in the input set, only for contiguous groups
+        self.first = first
+        self.last = last
 
-        self.sel = SpiderDocFile(self.selfile, 'w+')
-        self.doc = SpiderDocFile(self.docfile, 'w+')
-        self.doc.writeComment(self.docfile)
-        header = ['KEY', 'PSI', 'THE', 'PHI', 'REF#', 'EXP#', 'CUM.{ROT',
-                  'SX', 'SY}', 'NPROJ', 'DIFF', 'CCROT', 'ROT', 'SX', 'SY', 'MIR-CC']
-        self.doc.writeHeader(header)
+        self.locations = []  # location of each particle image
+        self.matrices = []  # alignment of each particle
 
     def addParticle(self, img):
         self.counter += 1
         if self.counter == 1:
             ctf = img.getCTF()
             self.defocus = (ctf.getDefocusU() + ctf.getDefocusV()) / 2.
-        self.ih.convert(img, (self.counter, self.stackfile))
-        self.sel.writeValues(self.counter)
-        alignRow = {ANGLE_PSI: 0.,
-                    ANGLE_THE: 0.,
-                    ANGLE_PHI: 0.,
-                    SHIFTX: 0.,
-                    SHIFTY: 0.}
+        self.locations.append(img.getLocation())
         alignment = img.getTransform()
-        
-        if alignment is not None:
-            alignmentToRow(alignment, alignRow, ALIGN_PROJ)
-            
-        values = [0.00, alignRow[ANGLE_THE], alignRow[ANGLE_PHI], 
-                  0.00, self.counter, 
-                  alignRow[ANGLE_PSI], alignRow[SHIFTX], alignRow[SHIFTY], 
-                  0.00, 0.00, 0.00, 0.00, 0.00, 0.00, 0.0]
-        self.doc.writeValues(*values)
-        
-    def close(self):
-        self.sel.close()
-        self.doc.close()
+        self.matrices.append(None if alignment is None
+                             else alignment.getMatrix())
+
+    def getManifestRow(self):
+        return {'group': self.number, 'particles': self.counter,
+                'defocus': self.defocus, 'first': self.first,
+                'last': self.last}
+
+    def write(self):
+        """ Write the stack, the selfile and the alignment docfile. """
+        ih = ImageHandler()
+        stack = SpiderStackWriter(self.stackfile)
+        for location in self.locations:
+            stack.write(ih.read(location).getData())
+        stack.close()
+
+        sel = SpiderDocFile(self.selfile, 'w+')
+        sel.writeArray(numpy.arange(1, self.counter + 1))
+        sel.close()
+        writeAlignmentDoc(self.docfile, self.matrices)
+
+
+def writeGroupFiles(groupInfo):
+    """ Write the files of a group, used from the worker processes. """
+    groupInfo.write()
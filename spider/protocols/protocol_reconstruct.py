@@ -30,15 +30,13 @@ from enum import Enum
 import pyworkflow.protocol.params as params
 from pyworkflow.constants import PROD
 from pyworkflow.protocol.constants import LEVEL_ADVANCED, STEPS_SERIAL
-from pwem.constants import ALIGN_PROJ
 from pwem.emlib.image import ImageHandler
 from pwem.objects import Volume
 import pyworkflow.utils as pwutils
 
-from ..utils import SpiderDocFile
-from ..constants import (BP_32F, ANGLE_PHI, ANGLE_PSI,
-                         ANGLE_THE, SHIFTX, SHIFTY)
-from ..convert import convertEndian, alignmentToRow
+from ..utils import SpiderStackWriter
+from ..constants import BP_32F
+from ..convert import readImageData, writeAlignmentDoc
 from .protocol_base import SpiderProtocol
 
 
@@ -94,33 +92,17 @@ class SpiderProtReconstruct(SpiderProtocol):
         partSet = self.inputParticles.get()
         ih = ImageHandler()
 
-        stackfile = self._getPath('particles.stk')
-        docfile = self._getPath('docfile.stk')
-        doc = SpiderDocFile(docfile, 'w+')
-        doc.writeComment(docfile)
-        header = ['KEY', 'PSI', 'THE', 'PHI', 'REF#', 'EXP#', 'CUM.{ROT',
-                  'SX', 'SY}', 'NPROJ', 'DIFF', 'CCROT', 'ROT', 'SX', 'SY', 'MIR-CC']
-        doc.writeHeader(header)
-
-        for i, img in enumerate(partSet):
-            ind = i + 1
-            ih.convert(img, (ind, stackfile))
-            alignRow = {ANGLE_PSI: 0.,
-                        ANGLE_THE: 0.,
-                        ANGLE_PHI: 0.,
-                        SHIFTX: 0.,
-                        SHIFTY: 0.}
+        stack = SpiderStackWriter(self._getPath('particles.stk'))
+        matrices = []
+
+        for img in partSet:
+            stack.write(readImageData(img, ih))
             alignment = img.getTransform()
-            
-            if alignment is not None:
-                alignmentToRow(alignment, alignRow, ALIGN_PROJ)
-                
-            values = [0.00, alignRow[ANGLE_THE], alignRow[ANGLE_PHI], 
-                      0.00, ind,  alignRow[ANGLE_PSI], alignRow[SHIFTX],
-                      alignRow[SHIFTY], 0.00, 0.00, 0.00, 0.00, 0.00, 0.00, 0.0]
-            doc.writeValues(*values)
-
-        convertEndian(stackfile, partSet.getSize())
+            matrices.append(None if alignment is None
+                            else alignment.getMatrix())
+
+        stack.close()
+        writeAlignmentDoc(self._getPath('docfile.stk'), matrices)
             
     def rotateStep(self):
         params = {'[unaligned_images]': "'particles'",
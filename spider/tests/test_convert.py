@@ -0,0 +1,111 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+from pwem.constants import ALIGN_2D, ALIGN_3D, ALIGN_PROJ
+from pwem.objects import Transform
+
+from ..utils import SpiderDocFile, SpiderStack, SpiderStackWriter
+from ..convert import (rowToAlignment, alignmentToRow,
+                       rowsToAlignments, alignmentsToRows)
+
+
+class TestSpiderFiles(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_stack(self):
+        images = numpy.random.rand(5, 16, 12).astype(numpy.float32)
+        stackFn = self.getOutputPath('stack.stk')
+        stack = SpiderStackWriter(stackFn)
+        for img in images:
+            stack.write(img)
+        stack.close()
+
+        stack = SpiderStack(stackFn)
+        self.assertEqual(stack.getDimensions(), (12, 16, 1, 5))
+        self.assertTrue(numpy.allclose(stack[:], images))
+        self.assertTrue(numpy.allclose(stack.getImages([5, 2]), images[[4, 1]]))
+        stack.close()
+
+    def test_docfile(self):
+        values = numpy.random.rand(10, 3) * 100
+        rowsFn = self.getOutputPath('rows.stk')
+        arrayFn = self.getOutputPath('array.stk')
+
+        doc = SpiderDocFile(rowsFn, 'w+')
+        for row in values:
+            doc.writeValues(*row)
+        doc.close()
+
+        doc = SpiderDocFile(arrayFn, 'w+')
+        doc.writeArray(values)
+        doc.close()
+
+        with open(rowsFn) as f1, open(arrayFn) as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+        doc = SpiderDocFile(arrayFn)
+        self.assertTrue(numpy.allclose(doc.readArray(), values, rtol=1e-5))
+        doc.close()
+
+
+class TestSpiderGeometry(BaseTest):
+    """ Check that batch conversions give the same results as
+    the per-particle ones. """
+    def _randomRows(self, n):
+        return {'ANGLE_PSI': numpy.random.uniform(-180, 180, n),
+                'ANGLE_PHI': numpy.random.uniform(-180, 180, n),
+                'ANGLE_THE': numpy.random.uniform(0, 180, n),
+                'SHIFTX': numpy.random.normal(0, 5, n),
+                'SHIFTY': numpy.random.normal(0, 5, n)}
+
+    def test_batchConversions(self):
+        n = 100
+        rows = self._randomRows(n)
+
+        for alignType in [ALIGN_2D, ALIGN_3D, ALIGN_PROJ]:
+            matrices = rowsToAlignments(rows, alignType)
+            for i in range(n):
+                row = {k: v[i] for k, v in rows.items()}
+                alignment = rowToAlignment(row, alignType)
+                self.assertTrue(numpy.allclose(alignment.getMatrix(),
+                                               matrices[i]))
+
+            # Flip some of them
+            matrices[::3, 0, :] *= -1
+            alignRows = alignmentsToRows(matrices, alignType)
+
+            for i in range(n):
+                alignment = Transform()
+                alignment.setMatrix(matrices[i])
+                alignRow = {}
+                alignmentToRow(alignment, alignRow, alignType)
+                for key, value in alignRow.items():
+                    self.assertAlmostEqual(alignRows[key][i], value, places=4)
@@ -0,0 +1,92 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import numpy
+
+from pyworkflow.tests import BaseTest
+
+from ..constants import (FILTER_TOPHAT, FILTER_SPACE_REAL, FILTER_FERMI,
+                         FILTER_BUTTERWORTH, FILTER_RAISEDCOS,
+                         FILTER_LOWPASS, FILTER_HIGHPASS)
+from ..filters import (getFrequencies, getFilterResponse, filterImages,
+                       CustomMask)
+
+
+class TestSpiderFilters(BaseTest):
+    def test_response(self):
+        freq = numpy.array([0., 0.1, 0.15, 0.2, 0.5])
+        tophat = getFilterResponse(freq, FILTER_TOPHAT, filterRadius=0.12)
+        self.assertTrue(numpy.allclose(tophat, [1, 1, 0, 0, 0]))
+        raisedCos = getFilterResponse(freq, FILTER_RAISEDCOS,
+                                      lowFreq=0.1, highFreq=0.2)
+        self.assertTrue(numpy.allclose(raisedCos, [1, 1, 0.5, 0, 0]))
+        # Butterworth response is 1/sqrt(1 + eps^2) at the low frequency
+        # and 1/aa at the high one
+        butterworth = getFilterResponse(freq, FILTER_BUTTERWORTH,
+                                        lowFreq=0.1, highFreq=0.2)
+        self.assertAlmostEqual(butterworth[1], 1 / numpy.sqrt(1 + 0.882**2), 5)
+        self.assertAlmostEqual(butterworth[3], 1 / 10.624, 5)
+
+    def test_filter(self):
+        images = numpy.random.rand(3, 32, 24).astype(numpy.float32)
+        freq = getFrequencies((32, 24))
+        self.assertEqual(freq.shape, (32, 13))
+
+        for filterType in [FILTER_SPACE_REAL, FILTER_FERMI,
+                           FILTER_BUTTERWORTH, FILTER_RAISEDCOS]:
+            low, high = [filterImages(images, filterType, mode,
+                                      usePadding=False)
+                         for mode in [FILTER_LOWPASS, FILTER_HIGHPASS]]
+            # Complementary filters without padding add up to the input
+            self.assertTrue(numpy.allclose(low + high, images, atol=1e-5))
+
+        # Padded filtering of a constant image keeps it unchanged
+        ones = numpy.ones((2, 16, 16))
+        filtered = filterImages(ones, FILTER_TOPHAT, filterRadius=0.1)
+        self.assertEqual(filtered.shape, ones.shape)
+        self.assertTrue(numpy.allclose(filtered, ones, atol=1e-5))
+
+        # Volumes are filtered as a whole with ndim=3
+        volume = numpy.random.rand(8, 8, 8)
+        filtered = filterImages(volume, FILTER_SPACE_REAL, ndim=3, workers=2)
+        self.assertEqual(filtered.shape, volume.shape)
+
+    def test_custommask(self):
+        yy, xx = numpy.mgrid[:32, :32]
+        image = numpy.exp(-((xx - 16) ** 2 + (yy - 16) ** 2) / 50.)
+        customMask = CustomMask(image)
+        images = customMask.compute(0.1, 0.6, 0.1, 0.5)
+        self.assertEqual(len(images), 7)
+        mask = images[3]
+        self.assertTrue(mask[16, 16] == 1 and mask[0, 0] == 0)
+        self.assertTrue(numpy.allclose(images[4], image * mask))
+        self.assertTrue(numpy.allclose(images[5] + mask, 1))
+
+        # Changing only the last threshold reuses the previous steps
+        filteredMask = images[2]
+        images = customMask.compute(0.1, 0.6, 0.1, 0.8)
+        self.assertIs(images[2], filteredMask)
+        self.assertLessEqual(images[3].sum(), mask.sum())
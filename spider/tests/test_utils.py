@@ -0,0 +1,444 @@
+# **************************************************************************
+# *
+# * Authors:     Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+
+import os
+import sys
+import stat
+import json
+import subprocess
+
+import numpy
+
+from pyworkflow.tests import BaseTest, setupTestOutput
+
+from .. import Plugin
+from ..utils import (SpiderShell, SpiderSessionPool, SpiderProgressMonitor,
+                     getScriptTemplate, SpiderStack, SpiderStackWriter,
+                     END_HEADER)
+from ..averages import computeClassAverages, writeClassAverages
+from ..capca import MultivariateAnalysis, getCircularMask
+from ..constants import CA, PCA
+from ..angles import (getEvenAngles, anglesToVectors, AngularIndex,
+                      writeAnglesDoc, readAnglesDoc)
+from ..cache import FileCache, hashFiles
+from ..partition import (getNumberOfGroups, balanceGroups,
+                         writeGroupManifest, readGroupManifest)
+
+# Minimal interpreter that only understands variable assignments,
+# VM (system calls, with variable substitution), MY FL and EN
+STUB_SPIDER = r"""#!%s
+import sys, subprocess, re
+lines = iter(sys.stdin.readline, '')
+ext = next(lines).strip()
+variables = {}
+for line in lines:
+    cmd = line.strip()
+    match = re.match(r'(\[\w+\])\s*=\s*(\S+)', cmd)
+    if match:
+        variables[match.group(1)] = float(match.group(2))
+    elif cmd.lower() in ('en', 'end', 'en d'):
+        break
+    elif cmd.lower() == 'my fl':
+        sys.stdout.flush()
+    elif cmd.lower() == 'vm':
+        sysCmd = re.sub(r'\{%%F20.6%%(\[\w+\])\}',
+                        lambda m: '%%f' %% variables[m.group(1)], next(lines))
+        sys.stdout.flush()
+        subprocess.call(sysCmd, shell=True)
+    else:
+        print(' *** UNDEFINED OPERATION: %%s' %% cmd, flush=True)
+""" % sys.executable
+
+
+class TestSpiderSessionPool(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+        cls.program = cls.getOutputPath('stub_spider.py')
+        with open(cls.program, 'w') as f:
+            f.write(STUB_SPIDER)
+        os.chmod(cls.program, os.stat(cls.program).st_mode | stat.S_IEXEC)
+
+    def test_session(self):
+        pool = SpiderSessionPool(size=1, program=self.program,
+                                 env=dict(os.environ), debug=False)
+        outputFn = self.getOutputPath('output.txt')
+        cwd = self.getOutputPath()
+
+        with pool.session(cwd=cwd, ext='stk') as spi:
+            spi.runFunction('VM', 'echo done > %s' % outputFn)
+            pid = spi._proc.pid
+        # Commands should be completed when leaving the session
+        self.assertTrue(os.path.exists(outputFn))
+
+        # The same interpreter should be reused for the same folder
+        with pool.session(cwd=cwd, ext='stk') as spi:
+            self.assertEqual(spi._proc.pid, pid)
+
+        pool.close()
+        self.assertFalse(spi.isAlive())
+
+    def test_duplex(self):
+        spi = SpiderShell(ext='stk', program=self.program, env=dict(os.environ),
+                          cwd=self.getOutputPath(), debug=False, duplex=True)
+        spi.runBatch(['[radius] = 3.5'])
+        self.assertAlmostEqual(spi.getVar('[radius]'), 3.5)
+
+        with self.assertRaises(RuntimeError):
+            spi.runBatch(['wrong command'])
+
+        # Batches with a lot of output, e.g. one line per particle
+        lines = spi.runBatch(['VM', 'seq 1 50000'])
+        self.assertEqual(len(lines), 50000)
+        self.assertEqual(lines[-1], '50000')
+        spi.close()
+
+
+class TestGroupPartition(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_balance(self):
+        self.assertEqual(getNumberOfGroups(1), 2)
+        self.assertEqual(getNumberOfGroups(3), 3)
+        self.assertEqual(getNumberOfGroups(3, groupsPerWorker=2), 6)
+
+        # Previously 10 particles in 3 groups were split as 5 + 5
+        ranges = balanceGroups(10, 3)
+        self.assertEqual(ranges, [(1, 4), (5, 7), (8, 10)])
+        for n, k in [(1000, 7), (5, 8), (17, 2)]:
+            sizes = [last - first + 1 for first, last in balanceGroups(n, k)]
+            self.assertEqual(sum(sizes), n)
+            self.assertEqual(len(sizes), min(n, k))
+            self.assertLessEqual(max(sizes) - min(sizes), 1)
+
+    def test_manifest(self):
+        groups = [{'group': i + 1, 'particles': last - first + 1,
+                   'first': first, 'last': last}
+                  for i, (first, last) in enumerate(balanceGroups(11, 2))]
+        manifestFn = self.getOutputPath('sel_group.stk')
+        writeGroupManifest(manifestFn, groups)
+
+        for g1, g2 in zip(groups, readGroupManifest(manifestFn)):
+            self.assertEqual(g2['defocus'], 0)
+            for k, v in g1.items():
+                self.assertEqual(g2[k], v)
+
+
+class TestFileCache(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def _writeFile(self, fn, size):
+        with open(self.getOutputPath(fn), 'wb') as f:
+            f.write(os.urandom(size))
+        return self.getOutputPath(fn)
+
+    def test_cache(self):
+        inputFn = self._writeFile('input.stk', 100)
+        key = hashFiles(inputFn, angStep=2.0)
+        self.assertNotEqual(key, hashFiles(inputFn, angStep=1.5))
+
+        cache = FileCache(self.getOutputPath('cache'), maxSize=2000)
+        outputs = [self._writeFile('out1.stk', 1000),
+                   self._writeFile('out2.stk', 200)]
+        restored = [self.getOutputPath('restored%d.stk' % i) for i in [1, 2]]
+        self.assertFalse(cache.get(key, restored))
+        cache.put(key, outputs)
+        self.assertTrue(cache.get(key, restored))
+        for fn1, fn2 in zip(outputs, restored):
+            with open(fn1, 'rb') as f1, open(fn2, 'rb') as f2:
+                self.assertEqual(f1.read(), f2.read())
+
+        # The least recently used entry is removed when the cache is full
+        os.utime(cache._getEntry(key), (0, 0))
+        cache.put('other', outputs)
+        self.assertFalse(cache.get(key, restored))
+        self.assertTrue(cache.get('other', restored))
+
+    def test_cache_folder(self):
+        outputDir = self.getOutputPath('CA')
+        os.makedirs(outputDir, exist_ok=True)
+        self._writeFile(os.path.join('CA', 'cas_IMC.stk'), 100)
+        self._writeFile(os.path.join('CA', 'cas_EIG.stk'), 50)
+
+        cache = FileCache(self.getOutputPath('cache_dirs'), maxSize=2000)
+        cache.put('ca', [outputDir])
+        restoredDir = self.getOutputPath('CA_restored')
+        self.assertTrue(cache.get('ca', [restoredDir]))
+        self.assertEqual(sorted(os.listdir(restoredDir)),
+                         ['cas_EIG.stk', 'cas_IMC.stk'])
+
+
+class TestAngularIndex(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_sampling(self):
+        angles = getEvenAngles(15)
+        self.assertTrue(numpy.all(angles[:, 1] <= 90))
+        self.assertTrue(numpy.all(angles[:, 2] < 360))
+        # Finer steps give about (15 / 5)^2 more directions
+        ratio = len(getEvenAngles(5)) / float(len(angles))
+        self.assertTrue(6 < ratio < 12)
+
+        anglesFn = self.getOutputPath('ref_angs.stk')
+        writeAnglesDoc(anglesFn, angles)
+        self.assertTrue(numpy.allclose(readAnglesDoc(anglesFn), angles,
+                                       atol=1e-3))
+
+    def test_neighbors(self):
+        angles = getEvenAngles(5)
+        index = AngularIndex(angles)
+        theta = numpy.array([10, 45, 120])
+        phi = numpy.array([30, 200, 300])
+        refVectors = anglesToVectors(angles[:, 1], angles[:, 2])
+        vectors = anglesToVectors(theta, phi)
+
+        for i, neighbors in enumerate(index.getNeighbors(theta, phi, 12)):
+            # Compare with the angular distance to all references,
+            # also to the mirrored direction
+            cos = numpy.abs(refVectors.dot(vectors[i]))
+            expected = numpy.where(cos >= numpy.cos(numpy.radians(12)))[0]
+            self.assertEqual(sorted(neighbors), expected.tolist())
+
+        reachable = index.getReachable(theta, phi, 12)
+        self.assertLess(len(reachable), len(angles))
+
+
+class TestProgressMonitor(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_progress(self):
+        logFn = self.getOutputPath('run.stdout')
+        progressFn = self.getOutputPath('progress.jsonl')
+        with open(logFn, 'w') as f:
+            f.write(" Iteration: 9  Refining group:    9    TIME: 10/17/26  14:00:00\n")
+
+        with SpiderProgressMonitor(logFn, progressFn, 'refine_01.pam'):
+            with open(logFn, 'a') as f:
+                f.write(" Iteration: 1  Resolution:  5.20\n")
+                f.write(" Iteration: 1  Refining group:    2    TIME: 10/17/26  14:02:11\n")
+                f.write(" Iteration: 1 Finished   TIME: 10/17/26  14:12:11\n")
+                # Time printed with a 12-hour clock, as in some locales
+                f.write(" Iteration: 2  Refining group:    1    TIME: 10/17/2026  08:59:35 PM\n")
+
+        with open(progressFn) as f:
+            events = [json.loads(line) for line in f]
+        # Lines before the script started are not parsed
+        self.assertEqual([e['stage'] for e in events],
+                         ['started', 'Iteration: 1 Refining group: 2',
+                          'Iteration: 1 Finished',
+                          'Iteration: 2 Refining group: 1'])
+        self.assertEqual(events[-1]['status'], 'finished')
+        self.assertNotIn('status', events[1])
+        self.assertEqual(events[1]['iteration'], 1)
+        self.assertEqual(events[1]['group'], 2)
+        self.assertIsNone(events[2]['group'])
+        for e in events:
+            self.assertEqual(e['script'], 'refine_01.pam')
+            self.assertGreaterEqual(e['elapsed'], 0)
+
+    def test_error(self):
+        logFn = self.getOutputPath('run_error.stdout')
+        progressFn = self.getOutputPath('progress_error.jsonl')
+        open(logFn, 'w').close()
+
+        with self.assertRaises(RuntimeError) as cm:
+            with SpiderProgressMonitor(logFn, progressFn, 'refine_02.pam',
+                                       interval=0.1):
+                # A process like the Spider interpreter running the script
+                proc = subprocess.Popen([sys.executable, '-c',
+                                         'import time; time.sleep(60)',
+                                         '@refine_02'])
+                with open(logFn, 'a') as f:
+                    f.write(" .OPERATION: AP SHC\n")
+                    f.write(" *** ERROR: FILE NOT FOUND\n")
+                    f.write(" *** FATAL ERROR ENCOUNTERED IN BATCH MODE\n")
+                # The process should be killed as soon as the error is read
+                self.assertNotEqual(proc.wait(timeout=10), 0)
+
+        self.assertIn('AP SHC', str(cm.exception))
+        with open(progressFn) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(events[-1]['stage'], 'started')
+        self.assertEqual(events[-1]['status'], 'failed')
+
+
+class TestScriptTemplate(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_render(self):
+        scriptFn = self.getOutputPath('script.spi')
+        with open(scriptFn, 'w') as f:
+            f.write(" [radius] = 10      ; Radius\n"
+                    " GLO [input] = 'img'  ; Input image\n"
+                    "fr l\n"
+                    "[output]out_img  ; Output image\n"
+                    " ; -- END BATCH HEADER --\n"
+                    " [radius] = 20      ; Not replaced\n"
+                    " EN\n")
+
+        template = getScriptTemplate(scriptFn)
+        self.assertEqual(sorted(template.vars),
+                         ['[input]', '[output]', '[radius]'])
+        self.assertEqual(template.getUnknownParams({'[radius]': 5, 'ext': 'stk'}),
+                         ['ext'])
+        self.assertEqual(template.render({'[radius]': 5, '[output]': 'mask'},
+                                         procedure=True),
+                         " [radius] = 5      ; Radius\n"
+                         " GLO [input] = 'img'  ; Input image\n"
+                         "fr l\n"
+                         "[output]mask  ; Output image\n"
+                         " ; -- END BATCH HEADER --\n"
+                         " [radius] = 20      ; Not replaced\n"
+                         "re\n")
+
+        # The template is only parsed again when the file is modified
+        self.assertIs(getScriptTemplate(scriptFn), template)
+        with open(scriptFn, 'a') as f:
+            f.write(" ; end\n")
+        os.utime(scriptFn, (0, 0))
+        self.assertIsNot(getScriptTemplate(scriptFn), template)
+
+    def test_render_refine(self):
+        # Only the parameters before the header end of the iteration
+        # scripts are replaced, the body must be kept as it is
+        for dirName in ['defocus-groups', 'no-defocus-groups']:
+            scriptFn = Plugin.getScript('projmatch', 'Refinement',
+                                        dirName, 'refine.pam')
+            with open(scriptFn) as f:
+                text = f.read()
+            body = text[text.index(END_HEADER):]
+            rendered = getScriptTemplate(scriptFn).render(
+                {'[iter-first]': 3, '[iter-last]': 3, '[iter-phase]': 1})
+            self.assertIn(" [iter-first] = 3 ", rendered)
+            self.assertIn(" [iter-last]  = 3 ", rendered)
+            self.assertTrue(rendered.endswith(body))
+
+        # Preparing the last iteration must not create the final outputs
+        scriptFn = Plugin.getScript('projmatch', 'Refinement',
+                                    'defocus-groups', 'refine.pam')
+        rendered = getScriptTemplate(scriptFn).render(
+            {'[iter-first]': 10, '[iter-last]': 10, '[iter-phase]': 1})
+        self.assertIn(" [iter-phase] = 1 ", rendered)
+        self.assertIn("   [do-final] = 0            ; Not merged yet\n"
+                      " ENDIF\n\n"
+                      " IF ( [do-final] == 1 ) THEN\n", rendered)
+
+
+class TestClassAverages(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_averages(self):
+        images = numpy.random.rand(50, 8, 8).astype(numpy.float32)
+        classes = numpy.random.randint(0, 4, 50)  # class 0 is not used
+        classes[:3] = [1, 2, 3]
+        stackFn = self.getOutputPath('particles.stk')
+        stack = SpiderStackWriter(stackFn)
+        for img in images:
+            stack.write(img)
+        stack.close()
+
+        for workers in [1, 3]:
+            averages, variances, counts = computeClassAverages(
+                stackFn, classes, 3, numberOfWorkers=workers, chunkSize=7)
+            for classId in [1, 2, 3]:
+                classImages = images[classes == classId]
+                self.assertEqual(counts[classId - 1], len(classImages))
+                self.assertTrue(numpy.allclose(averages[classId - 1],
+                                               classImages.mean(axis=0),
+                                               atol=1e-5))
+                if len(classImages) > 1:
+                    self.assertTrue(numpy.allclose(variances[classId - 1],
+                                                   classImages.var(axis=0, ddof=1),
+                                                   atol=1e-5))
+
+        writeClassAverages(averages, variances,
+                           self.getOutputPath('classavg%03d.stk'),
+                           self.getOutputPath('classvar%03d.stk'))
+        avg = SpiderStack(self.getOutputPath('classavg002.stk'))
+        self.assertTrue(numpy.allclose(avg.getImage(1), averages[1], atol=1e-5))
+        avg.close()
+
+
+class TestMultivariateAnalysis(BaseTest):
+    @classmethod
+    def setUpClass(cls):
+        setupTestOutput(cls)
+
+    def test_analysis(self):
+        # Images with 3 main factors plus some noise
+        rng = numpy.random.RandomState(0)
+        basis = rng.rand(3, 16 * 16)
+        images = (numpy.dot(rng.randn(200, 3) * [5, 3, 2], basis)
+                  + 0.01 * rng.randn(200, 16 * 16)).reshape(200, 16, 16)
+        stackFn = self.getOutputPath('particles.stk')
+        stack = SpiderStackWriter(stackFn)
+        for img in images.astype(numpy.float32):
+            stack.write(img)
+        stack.close()
+
+        mask = getCircularMask(16)
+        particles = numpy.arange(1, 201)
+        data = images[:, mask]
+        s = numpy.linalg.svd(data - data.mean(axis=0), compute_uv=False)
+
+        mda = MultivariateAnalysis(stackFn, particles, mask, PCA,
+                                   chunkSize=30)
+        mda.compute(5)
+        self.assertTrue(numpy.allclose(mda.eigenvalues[:3],
+                                       s[:3] ** 2 / 200, rtol=1e-3))
+
+        imcFn = self.getOutputPath('cas_IMC.stk')
+        eigFn = self.getOutputPath('cas_EIG.stk')
+        mda.writeImc(imcFn)
+        mda.writeEig(eigFn)
+        with open(imcFn) as f:
+            header = f.readline().split()
+            row = f.readline().split()
+        self.assertEqual(header[:2], ['200', '5'])
+        self.assertEqual(len(row), 5 + 4)
+        with open(eigFn) as f:
+            self.assertEqual(int(f.readline().split()[0]), 5)
+            self.assertEqual(len(f.readlines()), 5)
+
+        # CA needs positive data, the constant is computed if 0
+        mda = MultivariateAnalysis(stackFn, particles, mask, CA)
+        mda.compute(5)
+        self.assertTrue(mda.addConstant > 0)
+        self.assertTrue(numpy.all(mda.eigenvalues <= 1))
+        self.assertTrue(mda.eigenvalues.sum() <= mda.trace * (1 + 1e-6))
@@ -27,6 +27,7 @@
 import os
 
 from pwem.protocols import ProtImportParticles
+from pwem.emlib.image import ImageHandler
 from pyworkflow.tests import setupTestProject, DataSet
 from pyworkflow.utils import magentaStr
 from pwem.tests.workflows.test_workflow import TestWorkflow
@@ -58,7 +59,13 @@ class TestSpiderConvert(TestWorkflow):
         stackFn = self.getOutputPath('stack.stk')
         selFn = self.getOutputPath('stack_sel.stk')
         print("stackFn: ", stackFn)
-        writeSetOfImages(protImport.outputParticles, stackFn, selFn)
+        particles = protImport.outputParticles
+        writeSetOfImages(particles, stackFn, selFn)
+
+        # The stack should be readable with all particles and same dimensions
+        x, y, z, n = ImageHandler().getDimensions(stackFn)
+        self.assertEqual(n, particles.getSize())
+        self.assertEqual((x, y, z), particles.getDimensions())
 
 
 class TestSpiderWorkflow(TestWorkflow):
@@ -145,6 +152,18 @@ class TestSpiderWorkflow(TestWorkflow):
         nativeFiles.append(averages)
         self.validateFilesExist(nativeFiles)
 
+        # Classes selected in the viewer, from the stored dendrogram
+        root = protWard.getDendrogram()
+        nodes = root.getChilds()
+        classes = protWard._createSetOfClasses2D(protWard.inputParticles.get(),
+                                                 suffix='Selection')
+        protWard._fillClassesFromNodes(classes, nodes)
+        self.assertEqual(classes.getSize(), len(nodes))
+        for cls, node in zip(classes, nodes):
+            self.assertEqual(cls.getSize(), node.getSize())
+            self.assertEqual(cls.getRepresentative().getLocation(),
+                             (node.avgCount, averages))
+
         print(magentaStr("\n==> Testing spider - classify k-means:"))
         protKmeans = self.newProtocol(SpiderProtClassifyKmeans)
         protKmeans.pcaFile.set(protCAPCA.imcFile)
@@ -30,14 +30,24 @@ import datetime
 from collections import OrderedDict
 import subprocess
 import re
+import time
+import tempfile
+import threading
+import json
+from collections import deque
+from contextlib import contextmanager
+import warnings
 import logging
 logger = logging.getLogger(__name__)
 
+import numpy
+import psutil
 
 from pyworkflow.utils import runJob
 from pyworkflow.utils.path import replaceBaseExt, removeBaseExt
 
 from . import Plugin
+from .cache import hashFiles
 
 
 END_HEADER = 'END BATCH HEADER'
@@ -55,62 +65,181 @@ REGEX_KEYVALUE = re.compile(r"(?P<prefix>\s+GLO\s|[^[a-zA-Z0-9_-]*)(?P<var>\[?[a
 # just before a 'fr l' line
 REGEX_KEYFRL = re.compile(r"(?P<var>\[?[a-zA-Z0-9_-]+\]?)(?P<value>\S+)(?P<suffix>\s+.*)")
 
+# Match the EN (or EN D) command that ends the Spider session
+REGEX_END = re.compile(r"^\s*en(\s+d)?\s*(;.*)?$", re.IGNORECASE)
+
+# Match Spider error messages in its output
+REGEX_ERROR = re.compile(r"FATAL ERROR|\*\*\*\s*ERROR|UNDEFINED OPERATION|"
+                         r"forrtl: severe|Segmentation fault|"
+                         r"Program received signal",
+                         re.IGNORECASE)
+
+# Match the progress lines echoed by the scripts followed
+# by the output of 'date', e.g. ' Iteration: 3 Finished  TIME: 10/17/26  14:02:11'
+# After 'TIME:' any date format is accepted, since it depends on the locale
+REGEX_PROGRESS = re.compile(r"^\s*(?P<stage>.*?)[\s-]*"
+                            r"((TIME|Time):\s*\S.*|"
+                            r"\d\d/\d\d/\d\d\s+\d\d:\d\d:\d\d\s*)$")
+REGEX_ITERATION = re.compile(r"iter(ation)?:?\s*(?P<iter>\d+)", re.IGNORECASE)
+REGEX_GROUP = re.compile(r"group:?\s*(?P<group>\d+)", re.IGNORECASE)
+
 HEADER_COLUMNS = ['ANGLE_PSI2', 'ANGLE_THE',
                   'ANGLE_PHI', 'REF', 'EXP', 'ANGLE_PSI', 'SHIFTX',
                   'SHIFTY', 'NPROJ', 'DIFF', 'CCROT', 'ROT',
                   'SX', 'SY', 'MIR-CC']
 
+# Positions (1-based, as in Spider documentation) of the
+# header values that we need to write or read
+SPIDER_HEADER = {'nz': 1, 'ny': 2, 'irec': 3, 'iform': 5, 'imami': 6,
+                 'fmax': 7, 'fmin': 8, 'av': 9, 'sig': 10, 'nx': 12,
+                 'labrec': 13, 'scale': 21, 'labbyt': 22, 'lenbyt': 23,
+                 'istack': 24, 'inuse': 25, 'maxim': 26, 'imgnum': 27}
+
 
 def _getFile(*paths):
     return join(PATH, *paths)
 
 
-def __substituteVar(match, paramsDict, lineTemplate):
-    if match and match.groupdict()['var'] in paramsDict:
-        d = match.groupdict()
-        d['value'] = paramsDict[d['var']]
-        return lineTemplate % d
-    return None
-    
-    
-def writeScript(inputScript, outputScript, paramsDict):
+class ScriptTemplate(object):
+    """ Spider script parsed once into literal chunks and the slots
+    of the header lines whose values can be substituted.
+    The slots of each variable are indexed, so rendering the script
+    with some values is a single join.
+    """
+    # Format of substituted lines, from the groups of the regex
+    KEYVALUE_LINE = "%(prefix)s%(var)s%(s1)s=%(s2)s%(value)s%(suffix)s\n"
+    KEYFRL_LINE = "%(var)s%(value)s%(suffix)s\n"
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._parts = []  # literal strings or slot indexes
+        self._slots = []  # (line, [(var, lineTemplate, groups)])
+        self._endParts = []  # index of parts with EN commands
+        self.vars = {}  # var -> list of slot indexes
+
+        with open(filename, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+
+        inHeader = True  # After the end of header, no more value replacement
+        inFrL = False
+        chunk = []
+
+        for line in lines:
+            if END_HEADER in line:
+                inHeader = False
+            candidates = []
+            if inHeader:
+                candidates = self._getCandidates(line, inFrL)
+                inFrL = line.lower().startswith("fr ")
+
+            if candidates or REGEX_END.match(line):
+                if chunk:
+                    self._parts.append(''.join(chunk))
+                    chunk = []
+                if candidates:
+                    slotIndex = len(self._slots)
+                    self._slots.append((line, candidates))
+                    for var, _, _ in candidates:
+                        self.vars.setdefault(var, []).append(slotIndex)
+                    self._parts.append(slotIndex)
+                else:
+                    self._endParts.append(len(self._parts))
+                    self._parts.append(line)
+            else:
+                chunk.append(line)
+
+        if chunk:
+            self._parts.append(''.join(chunk))
+
+    def _getCandidates(self, line, inFrL):
+        """ Variables that can be replaced in this line, in order
+        of preference: '[key] = value' and '[key]value' after 'fr l'.
+        """
+        candidates = []
+        for regex, lineTemplate, use in [(REGEX_KEYVALUE, self.KEYVALUE_LINE, True),
+                                         (REGEX_KEYFRL, self.KEYFRL_LINE, inFrL)]:
+            match = regex.match(line) if use else None
+            if match:
+                groups = match.groupdict()
+                candidates.append((groups['var'], lineTemplate, groups))
+        return candidates
+
+    def getUnknownParams(self, paramsDict):
+        """ Return the params that are not variables of the script. """
+        return [k for k in paramsDict if k not in self.vars]
+
+    def render(self, paramsDict, procedure=False):
+        """ Return the script text with the values of paramsDict.
+        If procedure is True, the EN commands will be replaced by RE.
+        """
+        lines = []
+        for line, candidates in self._slots:
+            for var, lineTemplate, groups in candidates:
+                if var in paramsDict:
+                    try:
+                        line = lineTemplate % dict(groups, value=paramsDict[var])
+                    except Exception as ex:
+                        logger.error(f"{ex} in line: {line}")
+                    break
+            lines.append(line)
+
+        parts = [lines[p] if isinstance(p, int) else p for p in self._parts]
+        if procedure:
+            for i in self._endParts:
+                parts[i] = "re\n"
+        return ''.join(parts)
+
+
+# Parsed script templates, by filename, with their modification time
+_templatesCache = {}
+_templatesLock = threading.Lock()
+
+
+def getScriptTemplate(filename):
+    """ Return the parsed template of the script, it will
+    only be parsed again if the file is modified.
+    """
+    mtime = os.path.getmtime(filename)
+    with _templatesLock:
+        cached = _templatesCache.get(filename)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, ScriptTemplate(filename))
+            _templatesCache[filename] = cached
+    return cached[1]
+
+
+def writeScript(inputScript, outputScript, paramsDict, procedure=False):
     """ Create a new Spider script by substituting 
     params in the input 'paramsDict'.
+    If procedure is True, the EN commands will be replaced by RE,
+    so the script can be called with @ from a running interpreter
+    without ending it.
     """
-    fIn = open(Plugin.getScript(inputScript), 'r', encoding='utf-8')
-    fOut = open(outputScript, 'w', encoding='utf-8')
-    inHeader = True  # After the end of header, no more value replacement
-    inFrL = False
-
-    for i, line in enumerate(fIn):
-        if END_HEADER in line:
-            inHeader = False
-        if inHeader:
-            try:
-                newLine = __substituteVar(REGEX_KEYVALUE.match(line), paramsDict,
-                                          "%(prefix)s%(var)s%(s1)s=%(s2)s%(value)s%(suffix)s\n")
-                if newLine is None and inFrL:
-                    newLine = __substituteVar(REGEX_KEYFRL.match(line), paramsDict,
-                                              "%(var)s%(value)s%(suffix)s\n")
-                if newLine:
-                    line = newLine
-            except Exception as ex:
-                logger.error(f"{ex} in line ({i+1}: {line}")
-            inFrL = line.lower().startswith("fr ")
-        fOut.write(line)
-    fIn.close()
-    fOut.close()    
+    template = getScriptTemplate(Plugin.getScript(inputScript))
+    unknown = template.getUnknownParams(paramsDict)
+    if unknown:
+        logger.debug("Params not used in %s: %s"
+                     % (inputScript, ', '.join(map(str, unknown))))
+
+    with open(outputScript, 'w', encoding='utf-8') as fOut:
+        fOut.write(template.render(paramsDict, procedure))
      
     
 def runTemplate(inputScript, ext, paramsDict, nummpis=1,
-                program=None, log=None, cwd=None):
+                program=None, log=None, cwd=None, pool=None,
+                inputs=(), outputs=(), cache=None):
     """ This function will create a valid Spider script
     by copying the template and replacing the values in dictionary.
     After the new file is read, the Spider interpreter is invoked.
     Usually the execution should be done where the results will
     be left.
+    If a SpiderSessionPool is passed, the script will be run in one
+    of its interpreters instead of starting a new Spider process.
+    If a FileCache and the outputs (files or folders) are given, the
+    outputs are restored from the cache when the same script was
+    already run with the same inputs, instead of running it again.
     """
-    if program is None:
+    if program is None and pool is None:
         program = Plugin.getProgram()
 
     outputScript = replaceBaseExt(inputScript, ext)
@@ -119,9 +248,32 @@ def runTemplate(inputScript, ext, paramsDict, nummpis=1,
         outputScript = join(cwd, outputScript)
         
     # First write the script from the template with the substitutions
-    writeScript(inputScript, outputScript, paramsDict)
+    writeScript(inputScript, outputScript, paramsDict,
+                procedure=pool is not None)
+
+    def path(fn):
+        return fn if cwd is None else join(cwd, fn)
+
+    useCache = cache is not None and len(outputs) > 0
+    if useCache:
+        # The key includes the params, since they are in the script
+        cacheKey = hashFiles(outputScript, *[path(fn) for fn in inputs],
+                             version=Plugin.getActiveVersion())
+        if cache.get(cacheKey, [path(fn) for fn in outputs]):
+            logger.info("Outputs of %s restored from cache %s"
+                        % (inputScript, cacheKey))
+            return
+
     # Then proceed to run the script
-    runScript(outputScript, ext, program, nummpis, log, cwd)
+    if pool is None:
+        runScript(outputScript, ext, program, nummpis, log, cwd)
+    else:
+        with pool.session(cwd=cwd, ext=ext) as spi:
+            spi.runCmd('@' + removeBaseExt(outputScript))
+
+    # Some outputs may be optional, only complete runs are cached
+    if useCache and all(os.path.exists(path(fn)) for fn in outputs):
+        cache.put(cacheKey, [path(fn) for fn in outputs])
     
 
 def runScript(inputScript, ext, program, nummpis, log=None, cwd=None):
@@ -131,11 +283,141 @@ def runScript(inputScript, ext, program, nummpis, log=None, cwd=None):
            env=Plugin.getEnviron(), cwd=cwd)
     
 
+class SpiderProgressMonitor(object):
+    """ Follow the output log of a running Spider script and write
+    a progress event (in JSON lines) each time one of the stages
+    echoed by the script finishes, with its iteration, group and the
+    elapsed time. It should be used as a context manager around
+    the execution of the script:
+
+        with SpiderProgressMonitor(logFile, progressFile, 'refine_01.pam'):
+            runScript(...)
+
+    The event of the last stage also has the 'status' of the script,
+    'finished' or 'failed'.
+    Only the lines appended to the log after entering are parsed.
+    If a Spider error is found, the processes running the script are
+    killed (when killOnError is True) and a RuntimeError is raised
+    on exit, with the lines that precede the error.
+    """
+    def __init__(self, logFile, progressFile, script=None, interval=5,
+                 killOnError=True, contextLines=10):
+        self.logFile = logFile
+        self.progressFile = progressFile
+        self.script = script
+        self.interval = interval
+        self.killOnError = killOnError
+        self.errors = []
+        self._context = deque(maxlen=contextLines)
+        self._stage = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._logPos = 0
+
+    def __enter__(self):
+        # Only the lines written by the script will be parsed
+        if os.path.exists(self.logFile):
+            self._logPos = os.path.getsize(self.logFile)
+        self._progress = open(self.progressFile, 'a')
+        self._startStage('started')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self._stop.set()
+        self._thread.join()
+        self._readLines()
+        # The status of the script is kept in the event of its last stage
+        self._stage['status'] = ('failed' if excType or self.errors
+                                 else 'finished')
+        self._endStage()
+        self._progress.close()
+
+        if self.errors:
+            raise RuntimeError('Spider script error!\n' +
+                               '\n'.join(self.errors[0]))
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._readLines()
+
+    def _readLines(self):
+        if not os.path.exists(self.logFile):
+            return
+        with open(self.logFile) as f:
+            f.seek(self._logPos)
+            # Only parse complete lines, the rest is read next time
+            for line in iter(f.readline, ''):
+                if not line.endswith('\n'):
+                    break
+                self._logPos = f.tell()
+                self.parseLine(line)
+
+    def parseLine(self, line):
+        """ Start a new stage if the line is a progress line,
+        or keep the error and its context if it is an error.
+        """
+        line = line.rstrip('\n')
+        self._context.append(line)
+
+        if REGEX_ERROR.search(line):
+            self.errors.append(list(self._context))
+            if self.killOnError and len(self.errors) == 1:
+                self._killScript()
+            return
+
+        match = REGEX_PROGRESS.match(line)
+        if match and match.group('stage'):
+            self._startStage(match.group('stage'))
+
+    def _killScript(self):
+        """ Kill the child processes running the script, Spider
+        is run as '<program> <ext> @<script>'.
+        """
+        if self.script is None:
+            return
+        name = removeBaseExt(os.path.basename(self.script))
+        regex = re.compile(r'@(\S*/)?%s(\s|$)' % re.escape(name))
+        for proc in psutil.Process().children(recursive=True):
+            try:
+                if regex.search(' '.join(proc.cmdline())):
+                    logger.error("Killing %s after Spider error"
+                                 % ' '.join(proc.cmdline()))
+                    proc.kill()
+            except psutil.Error:  # already finished
+                pass
+
+    def _startStage(self, stage):
+        self._endStage()
+        iterMatch = REGEX_ITERATION.search(stage)
+        groupMatch = REGEX_GROUP.search(stage)
+        self._stage = {'script': self.script,
+                       'stage': ' '.join(stage.split()),
+                       'iteration': int(iterMatch.group('iter')) if iterMatch else None,
+                       'group': int(groupMatch.group('group')) if groupMatch else None,
+                       'start': time.time()}
+
+    def _endStage(self):
+        """ Write the event of the current stage, now finished. """
+        if self._stage is None:
+            return
+        event = dict(self._stage)
+        event['end'] = time.time()
+        event['elapsed'] = round(event['end'] - event['start'], 3)
+        for key in ['start', 'end']:
+            event[key] = datetime.datetime.fromtimestamp(event[key]).isoformat()
+        self._progress.write(json.dumps(event) + '\n')
+        self._progress.flush()
+        self._stage = None
+
+
 def runCustomMaskScript(filterRadius1, sdFactor,
                         filterRadius2, maskThreshold,
                         workingDir, ext='stk',
                         inputImage='input_image',
-                        outputMask='stkmask'):
+                        outputMask='stkmask', pool=None, cache=None):
     """ Utility function to run the custommask.msa script.
     This function will be called from the custom mask protocol
     and from the wizards to create the mask.
@@ -148,30 +430,162 @@ def runCustomMaskScript(filterRadius1, sdFactor,
               '[output_mask]': outputMask,
               } 
     # Run the script with the given parameters
-    runTemplate('mda/custommask.msa', ext, params, cwd=workingDir)
+    runTemplate('mda/custommask.msa', ext, params, cwd=workingDir, pool=pool,
+                inputs=[inputImage.split('@')[0] + '.' + ext],
+                outputs=[outputMask + '.' + ext], cache=cache)
     
     
 class SpiderShell(object):
     """ This class will open a child process running Spider interpreter
     and will keep connection to send commands. 
+    Optional keyword arguments:
+        debug, log: print the commands sent to the log (or stdout).
+        cwd: working directory of the interpreter.
+        program: Spider executable, by default Plugin.getProgram().
+        env: environment of the interpreter, by default Plugin.getEnviron().
+        duplex: if True, the interpreter output is captured, allowing
+            to read back variable values and to detect errors.
     """
     def __init__(self, ext='spi', **kwargs):
         self._debug = kwargs.get('debug', True)
         self._log = kwargs.get('log', None)
-        cwd = kwargs.get('cwd', None)
-        
-        FNULL = open(os.devnull, 'w')
-        cmd = Plugin.getProgram().split()
+        self._duplex = kwargs.get('duplex', False)
+        self._syncCount = 0
+        self.ext = ext
+        self.cwd = os.path.abspath(kwargs.get('cwd', None) or os.getcwd())
+        program = kwargs.get('program', None) or Plugin.getProgram()
+        env = kwargs.get('env', None) or Plugin.getEnviron()
+
+        if self._duplex:
+            stdout, stderr = subprocess.PIPE, subprocess.STDOUT
+        else:
+            stdout = stderr = open(os.devnull, 'w')
+        cmd = program.split()
         self._proc = subprocess.Popen(cmd,
                                       stdin=subprocess.PIPE,
-                                      stdout=FNULL, stderr=FNULL,
-                                      env=Plugin.getEnviron(),
-                                      cwd=cwd,
+                                      stdout=stdout, stderr=stderr,
+                                      env=env,
+                                      cwd=self.cwd,
                                       universal_newlines=True)
+        if self._duplex:
+            self._output = []
+            self._eof = False
+            self._outputCond = threading.Condition()
+            self._reader = threading.Thread(target=self._readOutput,
+                                            daemon=True)
+            self._reader.start()
+
         if self._debug and self._log:
             self._log = open(self._log, 'w+')
             
         self.runCmd(ext)
+
+    def _readOutput(self):
+        """ Collect the interpreter output lines (in a separate thread). """
+        for line in self._proc.stdout:
+            with self._outputCond:
+                self._output.append(line.rstrip('\n'))
+                self._outputCond.notify_all()
+        with self._outputCond:
+            self._eof = True
+            self._outputCond.notify_all()
+
+    def _waitForLine(self, regex, timeout=None):
+        """ Wait for an output line matching the regex.
+        Return the lines before it and the match.
+        """
+        end = None if timeout is None else time.time() + timeout
+        scanned = 0  # only match the lines added since the last wakeup
+
+        with self._outputCond:
+            while True:
+                for i in range(min(scanned, len(self._output)),
+                               len(self._output)):
+                    match = regex.match(self._output[i].strip())
+                    if match:
+                        lines = self._output[:i]
+                        self._output = self._output[i+1:]
+                        return lines, match
+                scanned = len(self._output)
+                if self._eof:
+                    raise RuntimeError('Spider interpreter exited unexpectedly.'
+                                       '\n' + '\n'.join(self._output[-20:]))
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise RuntimeError('Timeout waiting for Spider commands.')
+                self._outputCond.wait(remaining)
+
+    def _checkErrors(self, lines):
+        errors = [line for line in lines if REGEX_ERROR.search(line)]
+        if errors:
+            raise RuntimeError('Spider error:\n' + '\n'.join(errors))
+
+    def getOutput(self):
+        """ Return (and clear) the output lines captured so far
+        (only in duplex mode).
+        """
+        with self._outputCond:
+            lines, self._output = self._output, []
+        return lines
+
+    def runBatch(self, cmds, timeout=None):
+        """ Send several commands and wait until all of them are done.
+        In duplex mode, return the output lines and raise an error
+        if Spider reported any.
+        """
+        for cmd in cmds:
+            self.runCmd(cmd)
+        return self.sync(timeout)
+
+    def getVar(self, varName, timeout=None):
+        """ Return the value of a variable (e.g. '[radius]')
+        or register (e.g. 'x11') in the interpreter (only in duplex mode).
+        """
+        self._syncCount += 1
+        marker = '__SPIDER_VAR_%d__' % self._syncCount
+        self.runFunction('VM', 'echo %s {%%F20.6%%%s}' % (marker, varName))
+        lines, match = self._waitForLine(
+            re.compile(r"%s\s+(?P<value>\S+)$" % marker), timeout)
+        self._checkErrors(lines)
+
+        return float(match.group('value'))
+
+    def isAlive(self):
+        return self._proc.poll() is None
+
+    def sync(self, timeout=None):
+        """ Wait until all commands sent so far have been executed.
+        A system call (VM) is sent to the interpreter and we wait for
+        its result: a marker in the output (in duplex mode, also checking
+        for errors and returning the output lines) or a sentinel file.
+        """
+        self._syncCount += 1
+
+        if self._duplex:
+            marker = '__SPIDER_SYNC_%d__' % self._syncCount
+            self.runFunction('VM', 'echo %s' % marker)
+            lines, _ = self._waitForLine(re.compile(re.escape(marker) + '$'),
+                                         timeout)
+            self._checkErrors(lines)
+            return lines
+
+        sentinel = os.path.join(tempfile.gettempdir(), 'spider_sync_%d_%d'
+                                % (self._proc.pid, self._syncCount))
+        self.runFunction('VM', 'touch %s' % sentinel)
+        start = time.time()
+
+        while not os.path.exists(sentinel):
+            if not self.isAlive():
+                raise RuntimeError('Spider interpreter exited unexpectedly.')
+            if timeout is not None and time.time() - start > timeout:
+                raise RuntimeError('Timeout waiting for Spider commands.')
+            time.sleep(0.005)
+        os.remove(sentinel)
+
+    def reset(self):
+        """ Prepare the interpreter to be reused for another job. """
+        self.sync()
+        self.runFunction('MY FL')
         
     def runFunction(self, funcName, *args):
         cmd = funcName
@@ -190,7 +604,99 @@ class SpiderShell(object):
             self.runCmd("end")
         self._proc.wait()
         # self._proc.kill() # TODO: Check if necessary
-        
+
+    def kill(self):
+        self._proc.kill()
+        self._proc.wait()
+
+
+class SpiderSessionPool(object):
+    """ Keep a number of running Spider interpreters (SpiderShell)
+    for each working directory and extension, so short jobs
+    (like the wizards previews) do not pay the Spider startup time.
+    Registers and variables are not cleared between jobs,
+    so scripts should always set the values they use.
+    """
+    def __init__(self, size=2, **kwargs):
+        """ Params:
+            size: maximum number of idle interpreters kept per
+                working directory and extension.
+            kwargs: passed to SpiderShell (program, env, debug, log, duplex).
+        """
+        self._size = size
+        self._kwargs = dict(kwargs)
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, cwd=None, ext='spi'):
+        """ Return a running interpreter, starting one if needed. """
+        key = (os.path.abspath(cwd or os.getcwd()), ext)
+
+        with self._lock:
+            shells = self._idle.get(key, [])
+            while shells:
+                shell = shells.pop()
+                if shell.isAlive():
+                    return shell
+
+            if 'env' not in self._kwargs:
+                # Build the Spider environment only once
+                self._kwargs['env'] = Plugin.getEnviron()
+
+        return SpiderShell(ext=ext, cwd=key[0], **self._kwargs)
+
+    def release(self, shell):
+        """ Wait for the job to finish and keep the interpreter
+        for later use (or close it if there are enough idle ones).
+        """
+        if not shell.isAlive():
+            return
+        try:
+            shell.reset()
+        except Exception:
+            shell.kill()
+            raise
+
+        with self._lock:
+            shells = self._idle.setdefault((shell.cwd, shell.ext), [])
+            if len(shells) < self._size:
+                shells.append(shell)
+                return
+        shell.close()
+
+    @contextmanager
+    def session(self, cwd=None, ext='spi'):
+        """ Use an interpreter within a 'with' block. When leaving the
+        block all the commands sent are guaranteed to be completed.
+        """
+        shell = self.acquire(cwd, ext)
+        try:
+            yield shell
+        except Exception:
+            shell.kill()
+            raise
+        self.release(shell)
+
+    def close(self):
+        """ Close all idle interpreters. """
+        with self._lock:
+            shells = [s for v in self._idle.values() for s in v]
+            self._idle = {}
+        for shell in shells:
+            if shell.isAlive():
+                shell.close()
+
+
+_sessionPool = None
+
+
+def getSessionPool():
+    """ Return the pool of Spider interpreters shared in this process. """
+    global _sessionPool
+    if _sessionPool is None:
+        _sessionPool = SpiderSessionPool(debug=False, duplex=True)
+    return _sessionPool
+
 
 class SpiderDocFile(object):
     """ Handler class to read/write spider docfile. """
@@ -246,6 +752,44 @@ class SpiderDocFile(object):
             
         print(line, file=self._file)
         
+    def writeArray(self, values, keys=None, chunkSize=100000):
+        """ Write all rows of a 2D array in spider docfile,
+        with the same format as writeValues.
+        Params:
+            values: array of shape (n, ncols) (or (n,) for a single column).
+            keys: the key of each row, if None the keys will continue
+                from the last one written.
+            chunkSize: number of rows formatted at once.
+        """
+        values = numpy.asarray(values, dtype=float)
+        if values.ndim == 1:
+            values = values[:, None]
+        n, ncols = values.shape
+
+        if keys is None:
+            keys = numpy.arange(self._count + 1, self._count + n + 1)
+
+        data = numpy.empty((n, ncols + 2))
+        data[:, 0] = keys
+        data[:, 1] = ncols
+        data[:, 2:] = values
+        lineFmt = "%5d %2d" + " %11g" * ncols + "\n"
+
+        for i in range(0, n, chunkSize):
+            chunk = data[i:i + chunkSize]
+            self._file.write((lineFmt * len(chunk)) % tuple(chunk.ravel().tolist()))
+        self._count += n
+
+    def readArray(self):
+        """ Read all data values of the docfile in a single pass.
+        Return an array of shape (n, ncols), without the key
+        and the columns count, the same values as iterValues.
+        """
+        with warnings.catch_warnings():  # empty docfiles are valid
+            warnings.simplefilter('ignore', UserWarning)
+            data = numpy.loadtxt(self._file, comments=';', ndmin=2)
+        return data[:, 2:]
+
     def iterValues(self):
         for line in self._file:
             line = line.strip()
@@ -260,6 +804,157 @@ class SpiderDocFile(object):
         self._file.close()
 
 
+def spiderHeader(nx, ny, nz=1, **kwargs):
+    """ Create a Spider header (as a big-endian float32 array)
+    for an image of the given dimensions.
+    Other header values can be passed as keyword arguments using
+    the names in SPIDER_HEADER.
+    """
+    lenbyt = nx * 4
+    labrec = 1024 // lenbyt
+    if 1024 % lenbyt:
+        labrec += 1
+    labbyt = labrec * lenbyt
+
+    values = {'nz': nz, 'ny': ny, 'irec': ny * nz + labrec,
+              'iform': 1 if nz == 1 else 3,
+              'nx': nx, 'labrec': labrec, 'scale': 1,
+              'labbyt': labbyt, 'lenbyt': lenbyt}
+    values.update(kwargs)
+
+    header = numpy.zeros(labbyt // 4, dtype='>f4')
+    for key, value in values.items():
+        header[SPIDER_HEADER[key] - 1] = value
+
+    return header
+
+
+class SpiderStackWriter(object):
+    """ Write images directly into a big-endian Spider stack.
+    Images are streamed to disk as they are written, with
+    the overall header updated when the stack is closed.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self._file = open(filename, 'wb')
+        self._count = 0
+        self._shape = None
+
+    def _writeOverallHeader(self):
+        nz, ny, nx = self._shape
+        header = spiderHeader(nx, ny, nz, istack=2, maxim=self._count)
+        self._file.write(header.tobytes())
+
+    def write(self, data):
+        """ Append the image data (2D or 3D numpy array) to the stack. """
+        data = numpy.asarray(data, dtype='>f4')
+        shape = data.shape if data.ndim == 3 else (1,) + data.shape
+
+        if self._shape is None:
+            self._shape = shape
+            self._writeOverallHeader()
+        elif shape != self._shape:
+            raise ValueError("Image dimensions %s do not match the stack "
+                             "dimensions %s" % (shape, self._shape))
+        self._count += 1
+        nz, ny, nx = shape
+        header = spiderHeader(nx, ny, nz, imami=1, inuse=1,
+                              imgnum=self._count,
+                              fmax=data.max(), fmin=data.min(),
+                              av=data.mean(), sig=data.std())
+        self._file.write(header.tobytes())
+        self._file.write(data.tobytes())
+
+    def getSize(self):
+        """ Return the number of images written so far. """
+        return self._count
+
+    def close(self):
+        if self._shape is not None:
+            # Update the number of images in the overall header
+            self._file.seek(0)
+            self._writeOverallHeader()
+        self._file.close()
+
+
+def readSpiderHeader(filename):
+    """ Read the header of a Spider file.
+    Return the header values and the data type (with the endianness)
+    in which the file is written.
+    """
+    with open(filename, 'rb') as f:
+        buffer = f.read(1024)
+
+    if len(buffer) < 1024:
+        raise IOError("File '%s' is too small to be a Spider file" % filename)
+
+    for dtype in ['>f4', '<f4']:
+        header = numpy.frombuffer(buffer, dtype=dtype)
+        nz, ny, nx, labbyt, lenbyt = [header[SPIDER_HEADER[k] - 1] for k in
+                                      ['nz', 'ny', 'nx', 'labbyt', 'lenbyt']]
+        if (nx >= 1 and ny >= 1 and nz >= 1 and lenbyt == nx * 4
+                and labbyt >= 1024 and labbyt % lenbyt == 0):
+            return header, numpy.dtype(dtype)
+
+    raise IOError("File '%s' does not have a valid Spider header" % filename)
+
+
+class SpiderStack(object):
+    """ Read-only access to a Spider image or stack through a memory-mapped
+    numpy array of shape (n, y, x), or (n, z, y, x) for volumes.
+    Images are only read from disk when accessed, so slicing does not
+    copy any data.
+    """
+    def __init__(self, filename):
+        self._filename = filename
+        self.header, self.dtype = readSpiderHeader(filename)
+        nx, ny, nz, labbyt = [self._getValue(k) for k in
+                              ['nx', 'ny', 'nz', 'labbyt']]
+        shape = (ny, nx) if nz == 1 else (nz, ny, nx)
+        size = nz * ny * nx
+
+        if self._getValue('istack') > 0:
+            n = self._getValue('maxim')
+            headerLength = labbyt // 4  # each image has its own header
+        else:
+            n = 1
+            headerLength = 0
+
+        if n == 0:
+            self.data = numpy.empty((0,) + shape, dtype=self.dtype)
+        else:
+            records = numpy.memmap(filename, dtype=self.dtype, mode='r',
+                                   offset=labbyt,
+                                   shape=(n, headerLength + size))
+            self.data = records[:, headerLength:].reshape((n,) + shape)
+
+    def _getValue(self, key):
+        return int(self.header[SPIDER_HEADER[key] - 1])
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, item):
+        """ Numpy-like access to the images (0-based). """
+        return self.data[item]
+
+    def getDimensions(self):
+        """ Return (x, y, z, n) as the ImageHandler does. """
+        return (self._getValue('nx'), self._getValue('ny'),
+                self._getValue('nz'), len(self))
+
+    def getImage(self, index):
+        """ Return the image at the given (1-based) index. """
+        return self.data[int(index) - 1]
+
+    def getImages(self, indexes):
+        """ Return an array with the images at the given (1-based) indexes. """
+        return self.data[numpy.asarray(indexes, dtype=int) - 1]
+
+    def close(self):
+        self.data = None
+
+
 class SpiderDocAliFile(object):
     """ Handler class to read Spider alignment metadata."""
     def __init__(self, filename, mode='r'):
@@ -279,6 +974,21 @@ class SpiderDocAliFile(object):
         self._file.close()
         
      
+def splitRange(n, k):
+    """ Split the (1-based) range 1..n into k contiguous
+    (first, last) ranges, whose sizes differ at most in one.
+    """
+    k = max(1, min(k, n))
+    d, r = divmod(n, k)
+    ranges = []
+    last = 0
+    for i in range(k):
+        first = last + 1
+        last = first + d - (0 if i < r else 1)
+        ranges.append((first, last))
+    return ranges
+
+
 def getDocsLink(op, label):
     from .constants import SPIDER_DOCS
     """ Return a label for documentation url of a given command. """
@@ -26,6 +26,7 @@
 
 from os.path import join
 
+import numpy
 import tkinter as tk
 
 from pwem.protocols import ProtUserSubSet
@@ -44,6 +45,7 @@ from pyworkflow.gui.canvas import Canvas, Item
 from pyworkflow.gui.dialog import askString
 
 from ..utils import SpiderDocFile
+from ..averages import computeClassAverages, writeClassAverages
 from ..protocols import SpiderProtClassifyWard, SpiderProtClassifyDiday
 
 
@@ -80,7 +82,7 @@ class SpiderViewerClassify(ProtocolViewer):
         self.step = 0.25
         self.rightMost = 0.0  # Used to arrange leaf nodes at the bottom
         
-        node = self.protocol.buildDendrogram()
+        node = self.protocol.getDendrogram()
         self.plotNode(node, self.minHeight.get())    
         self.plt.set_xlim(0., self.rightMost + self.step)
         self.plt.set_ylim(-10, 105)
@@ -131,7 +133,7 @@ class SpiderViewerWard(SpiderViewerClassify):
                                  help='Maximum level of classes to show')
 
     def visualizeClasses(self, e=None):
-        node = self.protocol.buildDendrogram(writeAverages=False)
+        node = self.protocol.getDendrogram()
         g = Graph(root=node)
         self.graph = g
                
@@ -312,15 +314,24 @@ class SpiderViewerDiday(SpiderViewerClassify):
         classVar = 'classvar'
         classDoc = 'docclass'
         
+        # The averages are computed below, from the class-lists
         params = {'[class_dir]': classDir,
                   '[desired-classes]': self.numberOfClasses.get(),
+                  '[class-averages]': 0,
                   '[particles]': prot._params['particles'] + '@******',
                   '[class_doc]': join(classDir, classDoc + '***'), 
                   '[class_avg]': join(classDir, classAvg + '***'),
                   '[class_var]': join(classDir, classVar + '***'),        
                   }
         
-        prot.runTemplate('mda/classavg.msa', prot.getExt(), params)
+        ext = prot.getExt()
+        inputs = [join(classDir, 'docdendro.' + ext),
+                  prot._params['particles'] + '.' + ext]
+        outputs = [join(classDir, '%s%03d.%s' % (classDoc, classNum, ext))
+                   for classNum in range(1, self.numberOfClasses.get() + 1)]
+
+        prot.runTemplate('mda/classavg.msa', ext, params,
+                         inputs=inputs, outputs=outputs)
 
         particles = prot.inputParticles.get()
         particles.load()
@@ -336,11 +347,22 @@ class SpiderViewerDiday(SpiderViewerClassify):
         for classId in range(1, self.numberOfClasses.get()+1):
             docClass = prot._getPath(classDir, classDoc + '%03d.stk' % classId)
             doc = SpiderDocFile(docClass)
-            for values in doc.iterValues():
-                imgIndex = int(values[0])
+            for imgIndex in doc.readArray()[:, 0].astype(int).tolist():
                 classDict[imgIndex] = classId
             doc.close()
 
+        # Compute all class averages in a single pass over the particles
+        classes = numpy.zeros(particles.getSize(), dtype=int)
+        for imgIndex, classId in classDict.items():
+            classes[imgIndex - 1] = classId
+        averages, variances, _ = computeClassAverages(
+            prot._getFileName('particles'), classes,
+            self.numberOfClasses.get(),
+            numberOfWorkers=prot.numberOfThreads.get())
+        writeClassAverages(averages, variances,
+                           prot._getPath(classDir, classAvg + '%03d.stk'),
+                           prot._getPath(classDir, classVar + '%03d.stk'))
+
         updateItem = lambda p, i: p.setClassId(classDict[i])
 
         def updateClass(cls):
@@ -109,7 +109,8 @@ Examples:
         group.addParam('groupSelection', params.NumericRangeParam,
                        condition='not isGoldStdProt and groupFSC==1 and viewIter==0',
                        label="Groups list",
-                       help="Write the group list to visualize. See examples in iteration list")
+                       help="Write the group list to visualize. See examples in iteration list. "
+                            "If empty, all groups will be shown.")
         group.addParam('resolutionThresholdFSC', params.FloatParam, default=0.143,
                        expertLevel=params.LEVEL_ADVANCED,
                        label='Threshold in resolution plots',
@@ -152,7 +153,11 @@ Examples:
             return pwutils.getListFromRangeString(self.iterSelection.get(''))
 
     def _getGroups(self):
-        return pwutils.getListFromRangeString(self.groupSelection.get(''))
+        groupSelection = self.groupSelection.get('')
+        if groupSelection.strip():
+            return pwutils.getListFromRangeString(groupSelection)
+        # All groups from the manifest if none were selected
+        return [g['group'] for g in self.protocol._getGroupManifest()]
 
     def _getFinalPath(self, *paths):
         return self.protocol._getExtraPath('Refinement', 'final', *paths)
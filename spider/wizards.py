@@ -25,11 +25,9 @@
 # *
 # **************************************************************************
 
-import os
 import tkinter as tk
 from tkinter import ttk
 
-from pyworkflow.utils.path import cleanPath
 import pyworkflow.gui.dialog as dialog
 from pyworkflow.gui.widgets import LabelSlider, HotButton
 from pwem.constants import UNIT_PIXEL
@@ -40,10 +38,8 @@ from pwem.wizards import (EmWizard, ParticleMaskRadiusWizard,
                           ImagePreviewDialog, ListTreeProvider,
                           MaskRadiiPreviewDialog)
 
-from . import Plugin
-from .utils import SpiderShell, runCustomMaskScript
 from .constants import FILTER_FERMI
-from .convert import locationToSpider
+from .filters import FourierFilter, CustomMask
 from .protocols import (SpiderProtCAPCA, SpiderProtAlignAPSR,
                         SpiderProtAlignPairwise, SpiderProtFilter,
                         SpiderProtCustomMask, SpiderProtRefinement)
@@ -121,6 +117,9 @@ class SpiderParticlesMaskRadiiWizard(ParticlesMaskRadiiWizard):
 # FILTERS
 # =============================================================================
 
+# Time (ms) without slider moves before updating the filter preview
+PREVIEW_DELAY = 100
+
 
 class SpiderFilterParticlesWizard(FilterParticlesWizard):    
     _targets = [(SpiderProtFilter, ['filterRadius', 'lowFreq',
@@ -148,13 +147,6 @@ class SpiderFilterParticlesWizard(FilterParticlesWizard):
         protocol = form.protocol
         provider = self._getProvider(protocol)
 
-        installErrors = Plugin.validateInstallation()
-
-        if installErrors:
-            dialog.showError("SPIDER not properly installed.",
-                             "\n".join(installErrors),  form.root)
-            return
-
         if provider is not None:
             d = SpiderFilterDialog(form.root, provider, 
                                    protocolParent=protocol)
@@ -184,6 +176,10 @@ class SpiderFilterDialog(DownsampleDialog):
         self.message = "Filtering particle..."
         self.previewLabel = "Particle"
         self.rightImage = ImageHandler()._img
+        # Fourier transform of the last filtered particle
+        self._fourierFilter = None
+        self._fourierLocation = None
+        self._previewId = None
         
     def _createControls(self, frame):
         self.freqFrame = ttk.LabelFrame(frame, text="Frequencies", padding="5 5 5 5")
@@ -213,13 +209,26 @@ class SpiderFilterDialog(DownsampleDialog):
                              "Select an item first before preview", self)
         else:
             self._computeRightPreview()
+
+    def _schedulePreview(self, *args):
+        """ Update the preview when the sliders stop moving
+        for a while, instead of on every single move.
+        """
+        if self._previewId is not None:
+            self.after_cancel(self._previewId)
+        self._previewId = self.after(PREVIEW_DELAY, self._delayedPreview)
+
+    def _delayedPreview(self):
+        self._previewId = None
+        if self.lastObj is not None:
+            self._computeRightPreview()
             
     def getRadius(self):
         return self.radiusSlider.get()
     
     def addFreqSlider(self, label, value, col):
         slider = LabelSlider(self.freqFrame, label, to=0.5,
-                             value=value)
+                             value=value, callback=self._schedulePreview)
         slider.grid(row=0, column=col, padx=5, pady=5)
         return slider
     
@@ -234,76 +243,44 @@ class SpiderFilterDialog(DownsampleDialog):
     
     def updateFilteredImage(self):
         self.rightPreview.updateData(self.rightImage.getData())
+
+    def _getFourierFilter(self):
+        """ Return the Fourier transform of the selected particle,
+        only computing it when the selection changes.
+        """
+        location = self.lastObj.getLocation()
+
+        if location != self._fourierLocation:
+            img = ImageHandler().read(location)
+            self._fourierFilter = FourierFilter(
+                img.getData(), usePadding=self.protocolParent.usePadding.get())
+            self._fourierLocation = location
+
+        return self._fourierFilter
         
     def _computeRightPreview(self):
         """ This function should compute the right preview
         using the self.lastObj that was selected
         """
-        # Copy image to filter to Tmp project folder
-        outputName = os.path.join("Tmp", "filtered_particle")
-        outputPath = outputName + ".spi"
-        cleanPath(outputPath)
-
-        outputLoc = (1, outputPath)
-        ih = ImageHandler()
-        ih.convert(self.lastObj.getLocation(), outputLoc) 
-                
-        outputLocSpiStr = locationToSpider(1, outputName)
-        
+        filterType = self.protocolParent.filterType.get()
         pars = dict()
-        pars["filterType"] = self.protocolParent.filterType.get()
         pars["filterMode"] = self.protocolParent.filterMode.get()
-        pars["usePadding"] = self.protocolParent.usePadding.get()
-        pars["op"] = "FQ"
         
-        if self.protocolParent.filterType <= FILTER_FERMI:
+        if filterType <= FILTER_FERMI:
             pars['filterRadius'] = self.getRadius()
         else:
             pars['lowFreq'] = self.getLowFreq()
             pars['highFreq'] = self.getHighFreq()
             
-        if self.protocolParent.filterType == FILTER_FERMI:
+        if filterType == FILTER_FERMI:
             pars['temperature'] = self.getTemperature()
 
-        filter_spider(outputLocSpiStr, outputLocSpiStr, **pars)
-        
-        # Get output image and update filtered image
-        img = ImageHandler()._img
-        locXmippStr = ImageHandler.locationToXmipp((1, outputPath))
-        img.read(locXmippStr)
-        self.rightImage = img
-        self.updateFilteredImage()
-
-
-# TODO: Refactor this function to be used also by method filterParticles
-def filter_spider(inputLocStr, outputLocStr, **pars):
-    """ Function to filter an image located on inputLocStr and
-    write it to outputLocStr. """
-     
-    spi = SpiderShell()  # Create the Spider process to send commands
-    filterNumber = pars["filterType"] * 2 + 1
-    
-    # Consider low-pass or high-pass
-    filterNumber += pars["filterMode"]
-    
-    OP = pars["op"]
-    if not pars["usePadding"]:
-        OP += ' NP'
-        
-    args = []
-    
-    if pars["filterType"] <= FILTER_FERMI:
-        args.append(pars['filterRadius'])
-    else:
-        args.append('%f %f' % (pars['lowFreq'], pars['highFreq']))
-        
-    if pars["filterType"] == FILTER_FERMI:
-        args.append(pars['temperature'])
-        
-    spi.runFunction(OP, inputLocStr, outputLocStr, filterNumber, *args)
-    spi.close()
-    
-    
+        # Filter the cached Fourier transform, with the same
+        # filters as Spider FQ, without any disk round-trip
+        data = self._getFourierFilter().filter(filterType, **pars)
+        self.rightPreview.updateData(data)
+
+
 # -------------- Custom mask Wizard -------------------------------------------
 
 CUSTOMMASK_VARS = {'filterRadius1': 'First radius', 'sdFactor': 'First threshold',
@@ -361,6 +338,8 @@ class CustomMaskDialog(ImagePreviewDialog):
         self.message = "Generating mask..."
         self.ih = ImageHandler()
         self.rightImage = self.ih.createImage()
+        self._customMask = None
+        self._maskLocation = None
         
     def _createPreview(self, frame):
         """ Should be implemented by subclasses to 
@@ -404,29 +383,30 @@ class CustomMaskDialog(ImagePreviewDialog):
     def getVarValue(self, varName):
         return self._vars[varName].get()
     
+    def _getCustomMask(self):
+        """ Return the mask pipeline of the selected image,
+        only creating it when the selection changes.
+        """
+        location = self.lastObj.getLocation()
+
+        if location != self._maskLocation:
+            img = self.ih.read(location)
+            self._customMask = CustomMask(img.getData())
+            self._maskLocation = location
+
+        return self._customMask
+
     def _computeRightPreview(self, e=None):
         """ This function should compute the right preview
         using the self.lastObj that was selected
         """
-        prot = self.protocolParent  # short notation
-        tmp = prot.getProject().getTmpPath()
-        ext = prot.getExt()
-        # Convert input image to spider
-        imgPrefix = 'inputImage'
-        imgName = '%s.%s' % (imgPrefix, ext)
-        imgFn = os.path.join(tmp, imgName)
-        self.ih.convert(self.lastObj, (1, imgFn))
-        
-        runCustomMaskScript(self.getVarValue('filterRadius1'), 
-                            self.getVarValue('sdFactor'), 
-                            self.getVarValue('filterRadius2'), 
-                            self.getVarValue('maskThreshold'), 
-                            workingDir=tmp, ext=ext,
-                            inputImage=imgPrefix+'@1')
-        
-        for i, preview in enumerate(self._previews):
-            if i == 0:
-                self.rightImage.read(imgFn)
-            else:
-                self.rightImage.read('%d@%s/stkmask.%s' % (i, tmp, ext))
-            preview.updateData(self.rightImage.getData())
+        customMask = self._getCustomMask()
+        # Only the steps affected by the changed values are recomputed
+        images = customMask.compute(self.getVarValue('filterRadius1'),
+                                    self.getVarValue('sdFactor'),
+                                    self.getVarValue('filterRadius2'),
+                                    self.getVarValue('maskThreshold'))
+
+        for preview, data in zip(self._previews,
+                                 [customMask.image] + images):
+            preview.updateData(data)